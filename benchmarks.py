@@ -0,0 +1,248 @@
+import argparse
+import contextlib
+import csv
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+import numpy
+
+import jointSpendingCalculator
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_importtime(stderr):
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports[name.strip()] = int(cumulative)
+    return imports
+
+
+def benchmark_startup(runs):
+    wall_times = []
+    import_times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import jointSpendingCalculator"], cwd=HERE, capture_output=True, text=True, check=True)
+        wall_times.append(time.perf_counter() - start)
+        import_times.append(parse_importtime(result.stderr))
+
+    last_run = import_times[-1]
+    slowest = sorted(last_run.items(), key=lambda item: item[1], reverse=True)[:10]
+    return {
+        "runs": runs,
+        "median_wall_seconds": statistics.median(wall_times),
+        "median_import_microseconds": statistics.median(imports["jointSpendingCalculator"] for imports in import_times),
+        "pandas_imported": "pandas" in last_run,
+        "slowest_imports_microseconds": dict(slowest)
+    }
+
+
+def settle_pairwise(owed):
+    # the naive way to settle up, each pair of people nets off what they owe each other
+    transfers = []
+    for owner, row in enumerate(owed):
+        for person in range(owner + 1, len(owed)):
+            net = row[person] - owed[person][owner]
+            if net > 0:
+                transfers.append((person, owner, net))
+            elif net < 0:
+                transfers.append((owner, person, -net))
+    return transfers
+
+
+def benchmark_settlement(sizes, density, seed):
+    random_generator = numpy.random.default_rng(seed)
+    results = []
+    for size in sizes:
+        owed = random_generator.integers(1, 10000, size=(size, size)) * (random_generator.random((size, size)) < density)
+        numpy.fill_diagonal(owed, 0)
+
+        start = time.perf_counter()
+        pairwise_transfers = settle_pairwise(owed.tolist())
+        pairwise_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        balances = dict(enumerate((owed.sum(axis=1) - owed.sum(axis=0)).tolist()))
+        heap_transfers = jointSpendingCalculator.settle_up(balances)
+        heap_seconds = time.perf_counter() - start
+
+        results.append({
+            "people": size,
+            "pairwise_transfers": len(pairwise_transfers),
+            "pairwise_seconds": pairwise_seconds,
+            "settle_up_transfers": len(heap_transfers),
+            "settle_up_seconds": heap_seconds
+        })
+    return {"density": density, "seed": seed, "results": results}
+
+
+def generate_statement(path, bank, rows, people, merchants, random_generator):
+    # dates run forward a day every few rows, merchants are drawn with a long tail like real spending
+    bank_format = jointSpendingCalculator.BANK_FORMATS[bank]
+    merchant_numbers = numpy.minimum(random_generator.zipf(1.3, size=rows), merchants) - 1
+    amounts = random_generator.integers(50, 20000, size=rows)
+    money_in = random_generator.random(rows) < 0.05
+    start = datetime.date(2023, 1, 1)
+    balance = 1000000
+    with open(path, "w", newline="") as statement_file:
+        writer = csv.writer(statement_file)
+        writer.writerow(bank_format["header"])
+        for row in range(rows):
+            amount = f"{amounts[row] // 100}.{amounts[row] % 100:02d}"
+            balance += amounts[row] if money_in[row] else -amounts[row]
+            date = (start + datetime.timedelta(days=row // 5)).isoformat()
+            description = f"Merchant {merchant_numbers[row]} {people[merchant_numbers[row] % len(people)]}"
+            writer.writerow([date, description, "PURCHASE", amount if money_in[row] else "", "" if money_in[row] else amount, f"{balance / 100:.2f}"])
+
+
+def generate_statements(directory, rows, people, statements, merchants, seed):
+    '''Writes the same statements, rules and answers for the same arguments, so runs on different versions can be compared'''
+    random_generator = numpy.random.default_rng(seed)
+    names = [f"Person{number}" for number in range(people)]
+    statement_directory = os.path.join(directory, "statements")
+    os.makedirs(statement_directory, exist_ok=True)
+
+    banks = list(jointSpendingCalculator.BANK_FORMATS)
+    owners = {}
+    for number in range(statements):
+        bank = banks[number % len(banks)]
+        statement = f"{number:04d}_{bank.lower()}_statement.csv"
+        generate_statement(os.path.join(statement_directory, statement), bank, rows, names, merchants, random_generator)
+        owners[statement] = names[number % people]
+
+    rules = os.path.join(directory, "rules.csv")
+    with open(rules, "w", newline="") as rules_file:
+        writer = csv.writer(rules_file)
+        writer.writerow(["description", "type", "amount", "payers"])
+        for merchant in range(merchants):
+            payers = random_generator.choice(names, size=random_generator.integers(1, min(people, 4) + 1), replace=False)
+            writer.writerow([f"merchant {merchant} *", "", "", " ".join(payers)])
+
+    answers = os.path.join(directory, "answers.csv")
+    with open(answers, "w", newline="") as answers_file:
+        writer = csv.writer(answers_file)
+        writer.writerow(["statement", "row", "answer"])
+        writer.writerows((statement, "owner", owner) for statement, owner in owners.items())
+    return statement_directory + "/", owners, rules, answers
+
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def median_seconds(function, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+
+def benchmark_pipeline(rows, people, statements, merchants, seed, runs):
+    with tempfile.TemporaryDirectory() as directory:
+        statement_directory, owners, rules_file, answers_file = generate_statements(directory, rows, people, statements, merchants, seed)
+        rules = jointSpendingCalculator.AssignmentRules.from_file(rules_file)
+        bank_formats = {statement: jointSpendingCalculator.BANK_FORMATS[jointSpendingCalculator.detect_bank(statement_directory + statement)] for statement in owners}
+
+        def read_statements():
+            return [jointSpendingCalculator.read_statement(statement, bank_formats[statement]["outgoings"], owner, statement_directory, rules, ask=jointSpendingCalculator.refuse_to_ask, bank_format=bank_formats[statement]) for statement, owner in owners.items()]
+
+        def merge_and_write(write):
+            with open(statement_directory + "totals.csv", "w") as totals:
+                totals.write("owes\n")
+            for (owed_from_statement, names), owner in zip(read, owners.values()):
+                new_total_owed, header = jointSpendingCalculator.merge_owed_from_statement_with_totals(statement_directory, names, owner, "totals.csv", owed_from_statement)
+                if write:
+                    jointSpendingCalculator.write_to_totals_spreadsheet(statement_directory, header, "totals.csv", new_total_owed)
+
+        def headless_main():
+            for output in ("totals.csv", "totals.html"):
+                if os.path.exists(statement_directory + output):
+                    os.remove(statement_directory + output)
+            with patch("builtins.input", side_effect=[statement_directory, "totals"]), quiet():
+                jointSpendingCalculator.main(["--rules", rules_file, "--answers", answers_file])
+
+        with quiet():
+            read_seconds, read = median_seconds(read_statements, runs)
+        merge_seconds, _ = median_seconds(lambda: merge_and_write(False), runs)
+        merge_and_write_seconds, _ = median_seconds(lambda: merge_and_write(True), runs)
+        html_seconds, _ = median_seconds(lambda: jointSpendingCalculator.create_table_in_html_file(statement_directory, "totals.csv"), runs)
+        main_seconds, _ = median_seconds(headless_main, runs)
+
+    return {
+        "rows": rows,
+        "people": people,
+        "statements": statements,
+        "merchants": merchants,
+        "seed": seed,
+        "runs": runs,
+        "median_seconds": {
+            "read_statement": read_seconds,
+            "merge_owed_from_statement_with_totals": merge_seconds,
+            "write_to_totals_spreadsheet": merge_and_write_seconds - merge_seconds,
+            "create_table_in_html_file": html_seconds,
+            "main": main_seconds
+        },
+        "rows_per_second": rows * statements / main_seconds
+    }
+
+
+def version():
+    result = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=HERE, capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+
+def write_results(results, output):
+    text = json.dumps(dict(results, version=version(), python=sys.version.split()[0]), indent=2)
+    if output:
+        with open(output, "w") as results_file:
+            results_file.write(text + "\n")
+    print(text)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks for jointSpendingCalculator.py, results are printed as JSON.")
+    parser.add_argument("--output", help="also write the results to this file")
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    startup = benchmarks.add_parser("startup", help="time importing the module with python -X importtime")
+    startup.add_argument("--runs", type=int, default=5)
+
+    settlement = benchmarks.add_parser("settlement", help="compare settle_up with pairwise netting on random owes matrices")
+    settlement.add_argument("--people", type=int, nargs="+", default=[10, 100, 1000, 3000])
+    settlement.add_argument("--density", type=float, default=0.3, help="fraction of pairs where one person owes the other")
+    settlement.add_argument("--seed", type=int, default=0)
+
+    pipeline = benchmarks.add_parser("pipeline", help="time reading, merging, writing and the HTML table, then whole headless runs, on generated statements")
+    pipeline.add_argument("--rows", type=int, default=10000, help="transactions in each statement")
+    pipeline.add_argument("--people", type=int, default=6)
+    pipeline.add_argument("--statements", type=int, default=4)
+    pipeline.add_argument("--merchants", type=int, default=200, help="number of different descriptions")
+    pipeline.add_argument("--seed", type=int, default=0)
+    pipeline.add_argument("--runs", type=int, default=3)
+
+    arguments = parser.parse_args(argv)
+    if arguments.benchmark == "startup":
+        write_results(benchmark_startup(arguments.runs), arguments.output)
+    elif arguments.benchmark == "settlement":
+        write_results(benchmark_settlement(arguments.people, arguments.density, arguments.seed), arguments.output)
+    elif arguments.benchmark == "pipeline":
+        write_results(benchmark_pipeline(arguments.rows, arguments.people, arguments.statements, arguments.merchants, arguments.seed, arguments.runs), arguments.output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,4 +1,5 @@
 import pytest
+import shutil
 from jointSpendingCalculator import *
 from unittest.mock import patch
 
@@ -33,3 +34,17 @@ def delete_html_file(directory, totals_spreadsheet):
     yield
     html_file = totals_spreadsheet[:-4] + '.html'
     os.remove(directory + html_file)
+
+@pytest.fixture
+def statements_folder(tmp_path):
+    folder = tmp_path / 'statements'
+    folder.mkdir()
+    for statement in ['coop_statement.csv', 'monzo_statement.csv']:
+        shutil.copy('test_data/' + statement, folder / statement)
+    return folder
+
+@pytest.fixture
+def rules_file(tmp_path):
+    RULES_FILE = tmp_path / "rules.csv"
+    RULES_FILE.write_text("description,type,amount,payers\ntrain,,,Sophie Lou\nmusic,,,*SKIP*\n")
+    return RULES_FILE
@@ -1,7 +1,75 @@
+import argparse
 import os
+import sys
 import csv
-import pandas
+import numpy
 import re
+import json
+import hashlib
+import datetime
+import sqlite3
+import itertools
+import bisect
+import collections
+import math
+import heapq
+import concurrent.futures
+import functools
+import gzip
+import io
+import zipfile
+import threading
+import urllib.parse
+import select
+import contextlib
+import tempfile
+import stat
+import time
+from html import escape
+
+
+class Profile:
+    '''Wall time and counters for each stage of a run, collected only with --profile'''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    def add(self, stage, counter, amount=1):
+        counters = self.stages.setdefault(stage, {})
+        counters[counter] = counters.get(counter, 0) + amount
+
+    def report(self):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak_memory_in_mb = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+        return {"seconds": time.perf_counter() - self.started, "peak_memory_in_mb": peak_memory_in_mb, "stages": self.stages}
+
+    def save(self, path):
+        with open(path, "w") as profile_file:
+            json.dump(self.report(), profile_file, indent=2)
+
+
+PROFILE = None
+
+
+def profiled(stage):
+    # with no profile running this costs one global lookup per call
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if PROFILE is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                PROFILE.add(stage, "calls")
+                PROFILE.add(stage, "seconds", time.perf_counter() - start)
+        return wrapper
+    return decorator
+
 
 def add_trailing_slash_if_needed(directory_name):
     folder = directory_name
@@ -23,17 +91,93 @@ def find_folder():
     else:
         print('Folder not found.')
 
-def get_statements(folder, totals_spreadsheet):
-    statements = os.listdir(folder)
-    statements.remove(totals_spreadsheet)
+@profiled("get_statements")
+def get_statements(folder, totals_spreadsheet, answers_for=None):
+    statements = []
+    for statement in iter_statement_files(folder):
+        if statement == totals_spreadsheet:
+            continue
+        bank, first_date = peek_statement(folder + statement)
+        if bank is None and not bank_can_be_asked_for(folder, statement, answers_for):
+            print(f"Skipping {statement}, its header doesn't have the outgoings column of a bank that's known. Banks can be added with --banks.")
+            continue
+        statements.append((first_date or "", statement))
+    # oldest first, by the date of each statement's first transaction
     statements.sort()
-    return statements
+    return [statement for _, statement in statements]
+
+
+def iter_statement_files(folder, relative=""):
+    # statements can be in sub-directories, e.g. one for each year and month, gzipped, or in zip files
+    with os.scandir(folder + relative) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                yield from iter_statement_files(folder, relative + entry.name + "/")
+            elif entry.name.endswith(".zip"):
+                with zipfile.ZipFile(entry.path) as archive:
+                    for member in archive.namelist():
+                        if member.endswith(".csv") and not member.startswith("__MACOSX/"):
+                            yield relative + entry.name + "/" + member
+            elif entry.name.endswith((".csv", ".csv.gz")):
+                yield relative + entry.name
+
+
+def split_archive_path(path):
+    # a statement inside a zip file is named like archive.zip/statement.csv
+    archive, separator, member = path.partition(".zip/")
+    return (archive + ".zip", member) if separator else (path, None)
+
+
+def open_statement(path, binary=False):
+    archive, member = split_archive_path(path)
+    if member is not None:
+        # the member is decompressed as it is read, nothing is extracted to disk
+        statement_file = zipfile.ZipFile(archive).open(member)
+        return statement_file if binary else io.TextIOWrapper(statement_file, encoding="utf-8")
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb" if binary else "rt")
+    return open(path, "rb" if binary else "r")
 
-def create_totals_file(folder):
+
+def statement_size(path):
+    archive, member = split_archive_path(path)
+    if member is not None:
+        with zipfile.ZipFile(archive) as zipped:
+            return zipped.getinfo(member).compress_size
+    return os.path.getsize(path)
+
+
+def peek_statement(path):
+    with open_statement(path) as statement_file:
+        reader = csv.reader(statement_file)
+        header = next(reader, [])
+        bank = BANK_SIGNATURES.get(header_signature(header))
+        first_transaction = next(reader, None)
+    # a header that isn't known is sorted by a date in the standard column, if it has one
+    bank_format = BANK_FORMATS[bank] if bank is not None else {"columns": STANDARD_COLUMNS, "date_format": "%Y-%m-%d"}
+    columns = header_signature(header)
+    date_column = bank_format["columns"]["date"].strip().lower()
+    if first_transaction is None or date_column not in columns or columns.index(date_column) >= len(first_transaction):
+        return bank, None
+    return bank, iso_date(first_transaction[columns.index(date_column)], bank_format["date_format"])
+
+def bank_can_be_asked_for(folder, statement, answers_for=None):
+    # e.g. an export with an extra column, which bank it is from is asked for or taken from the answers
+    answers = answers_for(statement) if answers_for is not None else None
+    if answers is not None and known_bank(answers.answer_for("bank")) is not None:
+        return True
+    columns = header_signature(read_header(folder + statement))
+    return any(bank_format["outgoings"].strip().lower() in columns for bank_format in BANK_FORMATS.values())
+
+def create_totals_file(folder, reset=True):
     name_input = input('What would you like the spreadsheet with the final calculations to be called? ')
     filename = name_input + '.csv'
     directory = add_trailing_slash_if_needed(folder)
     path_to_file = directory + filename
+    if not reset and os.path.exists(path_to_file):
+        return filename
     with open(path_to_file, 'w') as totals:
         column_names = ["owes"] 
         csv_writer = csv.DictWriter(totals, fieldnames=column_names)
@@ -41,19 +185,237 @@ def create_totals_file(folder):
     return filename
 
 
-def whose_statement_and_which_bank(statement):
-    name = input(f"Who does this statement belong to: '{statement}'? ")
-    banks = {
-        "Co-operative": " Money Out",
-        "Monzo": "Amount"
+def iter_lines_in_ranges(answers_file, ranges):
+    for start, end in ranges:
+        answers_file.seek(start)
+        while answers_file.tell() < end:
+            yield answers_file.readline()
+
+
+def iter_answers(path, ranges=None):
+    # with ranges from an AnswersIndex only those parts of the file are read, otherwise all of it
+    with open(path, "rb") as answers_file:
+        header = None if path.endswith(".jsonl") else answers_file.readline().decode()
+        lines = (line.decode() for line in (answers_file if ranges is None else iter_lines_in_ranges(answers_file, ranges)))
+        if header is None:
+            for line in lines:
+                if line.strip():
+                    try:
+                        answer = json.loads(line)
+                    except ValueError:
+                        if line.endswith("\n"):
+                            raise
+                        # the last line of a journal can be cut short if the run stopped while it was written
+                        return
+                    yield {"statement": answer["statement"], "row": str(answer["row"]), "answer": answer["answer"]}
+        else:
+            yield from csv.DictReader(lines, next(csv.reader([header]), []))
+
+
+class AnswersIndex:
+    '''Where each statement's answers are in an answers file, found in one pass so each statement only reads its own'''
+
+    def __init__(self, path):
+        self.path = path
+        # byte ranges of each statement's answers, with answers next to each other in one range
+        self.ranges = {}
+        with open(path, "rb") as answers_file:
+            position = [0]
+
+            def iter_lines():
+                for line in answers_file:
+                    position[0] += len(line)
+                    yield line
+
+            lines = iter_lines()
+            if path.endswith(".jsonl"):
+                statements = (self._jsonl_statement(line) for line in lines)
+            else:
+                # a csv reader only takes the lines it needs for each row, so the position is where the row ends
+                reader = csv.reader(line.decode() for line in lines)
+                column = next(reader, ["statement"]).index("statement")
+                statements = (row[column] if row else None for row in reader)
+            start = position[0]
+            for statement in statements:
+                if statement is not None:
+                    ranges = self.ranges.setdefault(statement, [])
+                    if ranges and ranges[-1][1] == start:
+                        ranges[-1][1] = position[0]
+                    else:
+                        ranges.append([start, position[0]])
+                start = position[0]
+
+    @staticmethod
+    def _jsonl_statement(line):
+        if not line.strip():
+            return None
+        try:
+            return json.loads(line)["statement"]
+        except ValueError:
+            if line.endswith(b"\n"):
+                raise
+            return None
+
+    def answers_for(self, statement, fallback=None):
+        return StatementAnswers(self.path, statement, fallback, self.ranges.get(statement, []))
+
+
+class StatementAnswers:
+    '''Answers for one statement, read from an answers file as they are needed'''
+
+    def __init__(self, path, statement, fallback=None, ranges=None):
+        self.path = path
+        self.statement = statement
+        # answers that aren't in this file are looked for in the fallback
+        self.fallback = fallback
+        self.ranges = ranges
+        self._answers = (answer for answer in iter_answers(path, ranges) if answer["statement"] == statement)
+        self._read_ahead = {}
+
+    def answer_for(self, row):
+        row = str(row)
+        while row not in self._read_ahead:
+            answer = next(self._answers, None)
+            if answer is None:
+                return self._fallback_for(row)
+            self._read_ahead[answer["row"]] = answer["answer"]
+        answer = self._read_ahead.pop(row)
+        # a blank answer is the same as no answer, only *SKIP* skips a transaction
+        return answer if (answer or "").strip() else self._fallback_for(row)
+
+    def _fallback_for(self, row):
+        return self.fallback.answer_for(row) if self.fallback is not None else None
+
+
+def drop_partial_last_line(path, chunk_size=4096):
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as journal_file:
+        end = journal_file.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(position - chunk_size, 0)
+            journal_file.seek(start)
+            newline = journal_file.read(position - start).rfind(b"\n")
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+        if position != end:
+            journal_file.truncate(position)
+
+
+class Journal:
+    '''Every answer appended to a JSONL file as soon as it is given, so a run that stops part way through can be resumed'''
+
+    def __init__(self, path, resume=False, overwrite=False, sync_every=32, sync_seconds=1.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_seconds = sync_seconds
+        if resume:
+            # answers are appended after the last one written in full, not onto one cut short
+            drop_partial_last_line(path)
+        elif not overwrite and os.path.exists(path) and os.path.getsize(path):
+            raise FileExistsError(f"{path} already has answers in it, resume from it or choose to overwrite it")
+        self._file = open(path, "a" if resume else "w")
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def append(self, statement, row, answer):
+        self._file.write(json.dumps({"statement": statement, "row": row, "answer": answer}) + "\n")
+        # flushing hands the answer to the OS, so it survives the process dying; fsync is batched since it waits for the disk
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_seconds:
+            self.sync()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+BANK_FORMATS = {}
+BANK_SIGNATURES = {}
+STANDARD_COLUMNS = {"date": "Date", "description": "Description", "type": "Type"}
+
+
+def header_signature(header):
+    return tuple(column.strip().lower() for column in header)
+
+
+def register_bank_format(name, header, outgoings, sign="absolute", date_format="%Y-%m-%d", columns=None):
+    BANK_FORMATS[name] = {
+        "name": name,
+        "header": list(header),
+        "outgoings": outgoings,
+        "sign": sign,
+        "date_format": date_format,
+        "columns": dict(STANDARD_COLUMNS, **(columns or {}))
     }
-    print("Which bank is the statement from?")
-    for bank in banks:
-        print(f" - {bank}")
-    bank_name = input("")
-    while bank_name.strip().capitalize() not in banks:
+    BANK_SIGNATURES[header_signature(header)] = name
+
+
+def load_bank_formats(path):
+    with open(path, "r") as banks_file:
+        for name, bank_format in json.load(banks_file).items():
+            register_bank_format(name, **bank_format)
+
+
+register_bank_format("Co-operative", ["Date", "Description", "Type", "Money In", " Money Out", " Balance"], " Money Out")
+register_bank_format("Monzo", ["Date", "Description", "Type", "Money In", "Amount", " Balance"], "Amount")
+
+
+def read_header(path):
+    with open_statement(path) as statement_file:
+        return next(csv.reader(statement_file), [])
+
+
+def detect_bank(path):
+    return BANK_SIGNATURES.get(header_signature(read_header(path)))
+
+
+def whose_statement(statement, answers=None, journal=None):
+    name = answers.answer_for("owner") if answers is not None else None
+    if name is None:
+        name = input(f"Who does this statement belong to: '{statement}'? ")
+        if journal is not None:
+            journal.append(statement, "owner", name)
+    return name
+
+
+def which_bank(statement, directory=None, answers=None, journal=None):
+    bank_name = answers.answer_for("bank") if answers is not None else None
+    if bank_name is None and directory is not None:
+        bank_name = detect_bank(directory + statement)
+    if known_bank(bank_name) is not None:
+        return known_bank(bank_name)
+    if bank_name is None:
+        print("Which bank is the statement from?")
+        for bank in BANK_FORMATS:
+            print(f" - {bank}")
+        bank_name = input("")
+    while known_bank(bank_name) is None:
         bank_name = input('Bank not found. Please try again: ')
-    return name, banks[bank_name.strip().capitalize()]
+    if journal is not None:
+        journal.append(statement, "bank", known_bank(bank_name))
+    return known_bank(bank_name)
+
+
+def known_bank(bank_name):
+    banks = {bank.lower(): bank for bank in BANK_FORMATS}
+    return banks.get((bank_name or "").strip().lower())
+
+
+def whose_statement_and_which_bank(statement, answers=None):
+    name = whose_statement(statement, answers)
+    return name, BANK_FORMATS[which_bank(statement, answers=answers)]["outgoings"]
+
 
 def convert_all_values_to_floats(totals_spreadsheet):
     for row in totals_spreadsheet:
@@ -65,104 +427,1534 @@ def convert_all_values_to_floats(totals_spreadsheet):
                     row[person] = 0.0
     return totals_spreadsheet
 
-def triage_transactions(statement, outgoings_column_name, directory, statement_owner, totals_spreadsheet):
-    owed_from_statement, names = read_statement(statement, outgoings_column_name, statement_owner, directory)
+class Ledger:
+    '''Holds the owes matrix in memory so the totals spreadsheet is read once and written once per run'''
+
+    def __init__(self, directory, totals_spreadsheet, checkpoint_every=0, writer=None):
+        self.directory = directory
+        self.totals_spreadsheet = totals_spreadsheet
+        self.checkpoint_every = checkpoint_every
+        self.writer = writer
+        # people[name] is the column of that person, owners[name] the row they are owed on, amounts are in pence
+        self.people = {}
+        self.names = []
+        self.owners = {}
+        self.owner_names = []
+        self._matrix = numpy.zeros((4, 4), dtype=numpy.int64)
+        self._statements_since_flush = 0
+
+    @classmethod
+    def from_totals_file(cls, directory, totals_spreadsheet, checkpoint_every=0, writer=None):
+        ledger = cls(directory, totals_spreadsheet, checkpoint_every, writer)
+        with open(directory + totals_spreadsheet, "r") as read_totals:
+            totals_csv_object = csv.DictReader(read_totals)
+            header = list(totals_csv_object.fieldnames or ["owes"])
+            columns = [ledger.register(name) for name in header if name != "owes"]
+            for row in convert_all_values_to_floats(list(totals_csv_object)):
+                values = numpy.rint(numpy.array([row[name] for name in header if name != "owes"]) * 100)
+                ledger._matrix[ledger._row_for(row["owes"]), columns] = values
+        return ledger
+
+    @property
+    def header(self):
+        return ["owes"] + self.names
+
+    @property
+    def rows(self):
+        rows = []
+        for owner in self.owner_names:
+            row = {"owes": owner}
+            row.update(zip(self.names, pence_to_pounds(self._matrix[self.owners[owner], :len(self.names)]).tolist()))
+            rows.append(row)
+        return rows
+
+    def register(self, name):
+        column = self.people.get(name)
+        if column is None:
+            column = len(self.names)
+            self.people[name] = column
+            self.names.append(name)
+            self._grow(len(self.owner_names), column + 1)
+        return column
+
+    def _row_for(self, owner):
+        row = self.owners.get(owner)
+        if row is None:
+            row = len(self.owner_names)
+            self.owners[owner] = row
+            self.owner_names.append(owner)
+            self._grow(row + 1, len(self.names))
+        return row
+
+    def _grow(self, rows_needed, columns_needed):
+        rows, columns = self._matrix.shape
+        if rows_needed <= rows and columns_needed <= columns:
+            return
+        grown = numpy.zeros((max(rows, 2 * rows_needed), max(columns, 2 * columns_needed)), dtype=numpy.int64)
+        grown[:rows, :columns] = self._matrix
+        self._matrix = grown
+
+    @profiled("Ledger.apply")
+    def apply(self, statement_owner, names_from_statement, owed_from_current_statement):
+        for name in names_from_statement:
+            self.register(name)
+        row = self._row_for(statement_owner)
+        people = [person for person in owed_from_current_statement if person != "owes"]
+        columns = [self.register(person) for person in people]
+        self._matrix[row, columns] += [owed_from_current_statement[person] for person in people]
+
+        self._statements_since_flush += 1
+        if self.checkpoint_every and self._statements_since_flush >= self.checkpoint_every:
+            self.flush()
+
+    def flush(self):
+        if self.writer is not None:
+            # the rows are copied now, so the ledger can keep changing while they are written
+            self.writer.submit(write_to_totals_spreadsheet, self.directory, self.header, self.totals_spreadsheet, self.rows)
+        else:
+            write_to_totals_spreadsheet(self.directory, self.header, self.totals_spreadsheet, self.rows)
+        self._statements_since_flush = 0
+
+    def balances(self):
+        pence = self._matrix[:len(self.owner_names), :len(self.names)]
+        balances = dict(zip(self.names, (-pence.sum(axis=0)).tolist()))
+        for owner, owed_to_owner in zip(self.owner_names, pence.sum(axis=1).tolist()):
+            balances[owner] = balances.get(owner, 0) + owed_to_owner
+        return balances
+
+
+class BackgroundWriter:
+    '''Writes files on a thread of its own, one after another in the order they were submitted'''
+
+    def __init__(self):
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending = []
+
+    def submit(self, write, *args):
+        done = [future for future in self._pending if future.done()]
+        for future in done:
+            # raises here if an earlier write failed
+            future.result()
+        self._pending = [future for future in self._pending if future not in done]
+        self._pending.append(self._pool.submit(write, *args))
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        for future in self._pending:
+            future.result()
+        self._pending = []
+
+
+def settle_up(balances):
+    # greedily pair whoever is owed the most with whoever owes the most, which settles n people in at most n - 1 transfers
+    creditors = [(-pence, name) for name, pence in balances.items() if pence > 0]
+    debtors = [(pence, name) for name, pence in balances.items() if pence < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+    transfers = []
+    while creditors and debtors:
+        owed, creditor = heapq.heappop(creditors)
+        owing, debtor = heapq.heappop(debtors)
+        amount = min(-owed, -owing)
+        transfers.append((debtor, creditor, amount))
+        if -owed > amount:
+            heapq.heappush(creditors, (owed + amount, creditor))
+        if -owing > amount:
+            heapq.heappush(debtors, (owing + amount, debtor))
+    return transfers
+
+
+class LedgerDatabase:
+    '''Every transaction and who paid for it in SQLite, so the totals and questions like what someone owed last month are a query away'''
+    schema = '''
+        CREATE TABLE IF NOT EXISTS people (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS statements (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, owner_id INTEGER NOT NULL REFERENCES people(id));
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY,
+            statement_id INTEGER NOT NULL REFERENCES statements(id),
+            row INTEGER NOT NULL,
+            date TEXT,
+            description TEXT,
+            pence INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS assignments (
+            transaction_id INTEGER NOT NULL REFERENCES transactions(id),
+            person_id INTEGER NOT NULL REFERENCES people(id),
+            pence INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS transactions_by_statement ON transactions(statement_id);
+        CREATE INDEX IF NOT EXISTS transactions_by_date ON transactions(date);
+        CREATE INDEX IF NOT EXISTS assignments_by_person ON assignments(person_id);
+        CREATE INDEX IF NOT EXISTS assignments_by_transaction ON assignments(transaction_id);
+    '''
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(self.schema)
+
+    def close(self):
+        self.connection.close()
+
+    def add_statement(self, statement, statement_owner, names, assignments):
+        # one transaction per statement, replacing whatever the statement added last time it was read
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO people (name) VALUES (?)", [(name,) for name in [statement_owner] + names])
+            people = dict(self.connection.execute("SELECT name, id FROM people"))
+            self.connection.execute(
+                "INSERT INTO statements (name, owner_id) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET owner_id = excluded.owner_id",
+                (statement, people[statement_owner])
+            )
+            statement_id, = self.connection.execute("SELECT id FROM statements WHERE name = ?", (statement,)).fetchone()
+            self.connection.execute("DELETE FROM assignments WHERE transaction_id IN (SELECT id FROM transactions WHERE statement_id = ?)", (statement_id,))
+            self.connection.execute("DELETE FROM transactions WHERE statement_id = ?", (statement_id,))
+
+            first_id, = self.connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM transactions").fetchone()
+            self.connection.executemany(
+                "INSERT INTO transactions (id, statement_id, row, date, description, pence) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (transaction_id, statement_id, row_number, transaction.get("Date"), transaction.get("Description"), cost)
+                    for transaction_id, (row_number, transaction, cost, _) in enumerate(assignments, first_id)
+                ]
+            )
+            self.connection.executemany(
+                "INSERT INTO assignments (transaction_id, person_id, pence) VALUES (?, ?, ?)",
+                [
+                    (transaction_id, people[person], share)
+                    for transaction_id, ((_, _, _, people_who_owe), shares) in enumerate(iter_split_assignments(assignments), first_id)
+                    for person, share in zip(people_who_owe, shares)
+                ]
+            )
+
+    def totals(self):
+        return self.connection.execute('''
+            SELECT owner.name, person.name, SUM(assignments.pence)
+            FROM assignments
+            JOIN transactions ON transactions.id = assignments.transaction_id
+            JOIN statements ON statements.id = transactions.statement_id
+            JOIN people AS owner ON owner.id = statements.owner_id
+            JOIN people AS person ON person.id = assignments.person_id
+            WHERE lower(person.name) != lower(owner.name)
+            GROUP BY statements.owner_id, assignments.person_id
+        ''').fetchall()
+
+    def to_ledger(self, directory, totals_spreadsheet):
+        ledger = Ledger(directory, totals_spreadsheet)
+        for name, in self.connection.execute("SELECT name FROM people ORDER BY id"):
+            ledger.register(name)
+        owners = self.connection.execute("SELECT people.name FROM statements JOIN people ON people.id = statements.owner_id GROUP BY statements.owner_id ORDER BY MIN(statements.id)")
+        owed = {owner: {} for owner, in owners}
+        for owner, person, pence in self.totals():
+            owed[owner][person] = pence
+        for owner, owed_to_owner in owed.items():
+            ledger.apply(owner, [], owed_to_owner)
+        return ledger
+
+    def owed_by(self, person, start_date, end_date):
+        return dict(self.connection.execute('''
+            SELECT owner.name, SUM(assignments.pence)
+            FROM assignments
+            JOIN people AS person ON person.id = assignments.person_id
+            JOIN transactions ON transactions.id = assignments.transaction_id
+            JOIN statements ON statements.id = transactions.statement_id
+            JOIN people AS owner ON owner.id = statements.owner_id
+            WHERE person.name = ? AND transactions.date BETWEEN ? AND ? AND lower(person.name) != lower(owner.name)
+            GROUP BY statements.owner_id
+        ''', (person, start_date, end_date)))
+
+
+PERIOD_LABELS = {
+    "day": lambda day: day,
+    "month": lambda day: day[:7],
+    "quarter": lambda day: f"{day[:4]}-Q{(int(day[5:7]) + 2) // 3}",
+    "year": lambda day: day[:4]
+}
+
+
+class PeriodIndex:
+    '''What each person owed each statement owner on each day, with running totals so any period is two lookups'''
+
+    def __init__(self, statements=None):
+        # statements[statement] is a list of [day, owner, person, pence], summed for each day
+        self.statements = statements or {}
+        self._built = None
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, "r") as index_file:
+                return cls(json.load(index_file))
+        except FileNotFoundError:
+            return cls()
+
+    def save(self, path):
+        with atomic_write(path) as index_file:
+            json.dump(self.statements, index_file)
+
+    def add_statement(self, statement, statement_owner, assignments):
+        owed = collections.Counter()
+        owner = statement_owner.lower()
+        for (_, transaction, _, people_who_owe), shares in iter_split_assignments(assignments):
+            day = iso_date(transaction.get("Date"), "%Y-%m-%d")
+            if not re.fullmatch(r"\d{4}-\d{2}-\d{2}", day or ""):
+                # grouped transactions and rows without a date can't be put on a day
+                continue
+            for person, share in zip(people_who_owe, shares):
+                if person.lower() != owner:
+                    owed[day, statement_owner, person] += share
+        self.statements[statement] = [[day, statement_owner, person, pence] for (day, _, person), pence in sorted(owed.items())]
+        self._built = None
+
+    def keep(self, statements):
+        self.statements = {statement: owed for statement, owed in self.statements.items() if statement in statements}
+        self._built = None
+
+    def _build(self):
+        if self._built is None:
+            entries = [entry for owed in self.statements.values() for entry in owed]
+            days = sorted({day for day, _, _, _ in entries})
+            owners = list(dict.fromkeys(owner for _, owner, _, _ in entries))
+            people = list(dict.fromkeys(person for _, _, person, _ in entries))
+            day_numbers = {day: number for number, day in enumerate(days)}
+            owner_numbers = {owner: number for number, owner in enumerate(owners)}
+            person_numbers = {person: number for number, person in enumerate(people)}
+            # owed[d] is everything up to but not including days[d], so a period is the difference of two of them
+            owed = numpy.zeros((len(days) + 1, len(owners), len(people)), dtype=numpy.int64)
+            for day, owner, person, pence in entries:
+                owed[day_numbers[day] + 1, owner_numbers[owner], person_numbers[person]] += pence
+            self._built = (days, owners, people, numpy.cumsum(owed, axis=0))
+        return self._built
+
+    def owed_between(self, start, end):
+        # start and end are ISO dates and both are included
+        days, owners, people, running_totals = self._build()
+        owed = running_totals[bisect.bisect_right(days, end)] - running_totals[bisect.bisect_left(days, start)]
+        rows = []
+        for owner, owed_to_owner in zip(owners, owed):
+            if owed_to_owner.any():
+                row = {"owes": owner}
+                row.update(zip(people, pence_to_pounds(owed_to_owner).tolist()))
+                rows.append(row)
+        return ["owes"] + people, rows
+
+    def rolling(self, days, end):
+        start = (datetime.date.fromisoformat(end) - datetime.timedelta(days=days - 1)).isoformat()
+        return self.owed_between(start, end)
+
+    def periods(self, period="month"):
+        label = PERIOD_LABELS[period]
+        days = self._build()[0]
+        return [(name, min(group), max(group)) for name, group in ((name, list(group)) for name, group in itertools.groupby(days, label))]
+
+
+def triage_transactions(statement, outgoings_column_name, directory, statement_owner, totals_spreadsheet, *, ledger=None, rules=None, history=None, group=False, answers=None, seen=None, database=None, bank_format=None, prefetched=None, journal=None, periods=None, ask=None):
+    keep_assignments = database is not None or periods is not None
+    assignments = [] if keep_assignments else None
+    owed_from_statement, names = read_statement(statement, outgoings_column_name, statement_owner, directory, rules=rules, history=history, group=group, ask=ask or ask_who_should_pay, answers=answers, seen=seen, record=assignments.append if keep_assignments else None, bank_format=bank_format, prefetched=prefetched, journal=journal)
+    if database is not None:
+        database.add_statement(statement, statement_owner, names, assignments)
+    if periods is not None:
+        periods.add_statement(statement, statement_owner, assignments)
+    if ledger is not None:
+        ledger.apply(statement_owner, names, owed_from_statement)
+        return owed_from_statement, names
     new_total_owed, header = merge_owed_from_statement_with_totals(directory, names, statement_owner, totals_spreadsheet, owed_from_statement)
     write_to_totals_spreadsheet(directory, header, totals_spreadsheet, new_total_owed)
+    return owed_from_statement, names
+
+
+class StatementManifest:
+    '''What each statement added to the totals last time, so statements that haven't changed aren't asked about again'''
+
+    def __init__(self, directory, totals_spreadsheet):
+        self.directory = directory
+        self.filename = totals_spreadsheet[:-4] + ".manifest.json"
+        self.previous = {}
+        self.statements = {}
+        self._fingerprints = {}
+        if os.path.isfile(directory + self.filename):
+            with open(directory + self.filename, "r") as manifest_file:
+                self.previous = json.load(manifest_file)["statements"]
+
+    def fingerprint(self, statement):
+        status = os.stat(split_archive_path(self.directory + statement)[0])
+        previous = self.previous.get(statement)
+        # only hash the file again when its size or modification time has changed
+        if previous and previous["size"] == status.st_size and previous["modified"] == status.st_mtime_ns:
+            digest = previous["sha256"]
+        else:
+            sha256 = hashlib.sha256()
+            with open_statement(self.directory + statement, binary=True) as statement_file:
+                for block in iter(lambda: statement_file.read(1 << 20), b""):
+                    sha256.update(block)
+            digest = sha256.hexdigest()
+        self._fingerprints[statement] = {"sha256": digest, "size": status.st_size, "modified": status.st_mtime_ns}
+        return self._fingerprints[statement]
+
+    def cached(self, statement):
+        fingerprint = self.fingerprint(statement)
+        previous = self.previous.get(statement)
+        if previous is None or previous["sha256"] != fingerprint["sha256"]:
+            return None
+        self.statements[statement] = dict(previous, **fingerprint)
+        return self.statements[statement]
+
+    def record(self, statement, statement_owner, bank, owed_from_statement, names):
+        fingerprint = self._fingerprints.get(statement) or self.fingerprint(statement)
+        self.statements[statement] = dict(fingerprint, owner=statement_owner, bank=bank, owes=owed_from_statement, names=names)
+
+    def save(self):
+        with open(self.directory + self.filename, "w") as manifest_file:
+            json.dump({"statements": self.statements}, manifest_file, indent=1)
+
+
+AMOUNT_PATTERN = re.compile(r"[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)")
+CURRENCY_SYMBOLS = ("£", "$", "€", ",")
+
+
+def parse_outgoings(values, sign="absolute"):
+    # sign is how the bank writes money going out, "negative" or "positive" amounts, or "absolute" to count both
+    amounts = numpy.array([value or "" for value in values], dtype=str)
+    for symbol in CURRENCY_SYMBOLS:
+        amounts = numpy.char.replace(amounts, symbol, "")
+    amounts = numpy.char.strip(amounts)
+    negative = numpy.char.startswith(amounts, "-") | numpy.char.startswith(amounts, "(")
+    amounts = numpy.char.strip(amounts, "() ")
+
+    chargeable = numpy.fromiter((AMOUNT_PATTERN.fullmatch(amount) is not None for amount in amounts), dtype=bool, count=len(amounts))
+    costs = numpy.zeros(len(amounts), dtype=numpy.int64)
+    costs[chargeable] = numpy.rint(numpy.abs(amounts[chargeable].astype(numpy.float64)) * 100)
+    chargeable &= costs != 0
+    if sign == "negative":
+        chargeable &= negative
+    elif sign == "positive":
+        chargeable &= ~negative
+    return costs, chargeable
+
+
+def split_pence(pence, number_of_people, first=0):
+    # the pennies that don't divide evenly go one each to the people from first on, so the shares always add up to the cost
+    share, remainder = divmod(pence, number_of_people)
+    shares = numpy.full(number_of_people, share, dtype=numpy.int64)
+    shares[(first + numpy.arange(remainder)) % number_of_people] += 1
+    return shares
+
+
+def iter_split_assignments(assignments):
+    # leftover pennies are handed out in turn across transactions split between the same people, so no one always
+    # gets them, and each person's shares add up to what aggregate_owes works out for the whole statement
+    next_person = {}
+    for assignment in assignments:
+        people = tuple(assignment[3])
+        first = next_person.get(people, 0)
+        yield assignment, split_pence(assignment[2], len(people), first).tolist()
+        next_person[people] = (first + assignment[2]) % len(people)
+
+
+def pence_to_pounds(pence):
+    return pence / 100
+
+
+def iso_date(text, date_format):
+    try:
+        return datetime.datetime.strptime((text or "").strip(), date_format).date().isoformat()
+    except ValueError:
+        return text
+
+
+def iter_with_standard_columns(transactions, bank_format):
+    renamed = {STANDARD_COLUMNS[standard]: column for standard, column in bank_format["columns"].items() if STANDARD_COLUMNS[standard] != column}
+    for transaction in transactions:
+        for standard, column in renamed.items():
+            transaction[standard] = transaction.get(column)
+        if bank_format["date_format"] != "%Y-%m-%d":
+            transaction["Date"] = iso_date(transaction.get("Date"), bank_format["date_format"])
+        yield transaction
+
+
+def needs_standard_columns(bank_format):
+    return bank_format["date_format"] != "%Y-%m-%d" or any(STANDARD_COLUMNS[standard] != column for standard, column in bank_format["columns"].items())
+
+
+def iter_chargeable_transactions(transactions, outgoings_column_name, chunk_size=10000, sign="absolute"):
+    row_numbers = itertools.count(1)
+    while True:
+        chunk = list(itertools.islice(transactions, chunk_size))
+        if not chunk:
+            return
+        costs, chargeable = parse_outgoings([transaction.get(outgoings_column_name) for transaction in chunk], sign)
+        if PROFILE is not None:
+            PROFILE.add("read_statement", "rows_parsed", len(chunk))
+            PROFILE.add("read_statement", "rows_not_chargeable", len(chunk) - int(chargeable.sum()))
+        for row_number, transaction, cost, is_chargeable in zip(row_numbers, chunk, costs.tolist(), chargeable.tolist()):
+            if is_chargeable:
+                yield row_number, transaction, cost
+
+
+def iter_statement(path, outgoings_column_name, bank_format=None):
+    with open_statement(path) as persons_statement:
+        transactions = csv.DictReader(persons_statement)
+        if bank_format is not None and needs_standard_columns(bank_format):
+            transactions = iter_with_standard_columns(transactions, bank_format)
+        yield from iter_chargeable_transactions(transactions, outgoings_column_name, sign=bank_format["sign"] if bank_format is not None else "absolute")
+
+
+def people_from_answer(answer):
+    if answer.strip() == '*SKIP*':
+        return None
+    list_of_names_unformatted = answer.split(" ")
+    return [person.capitalize() for person in list_of_names_unformatted if person != ""]
+
+
+@profiled("ask_who_should_pay")
+def ask_who_should_pay(transaction, cost, suggestion=None):
+    print(f"\n{transaction}\n")
+    if suggestion is None:
+        ask_for_names_of_people = input("Including yourself, list the people who should pay for this transaction: ")
+        while ask_for_names_of_people.strip() == "":
+            ask_for_names_of_people = input("No one was entered. Please try again, or enter '*SKIP*': ")
+    else:
+        ask_for_names_of_people = input(f"Including yourself, list the people who should pay for this transaction [{suggestion}]: ")
+        if ask_for_names_of_people.strip() == "":
+            ask_for_names_of_people = suggestion
+    return people_from_answer(ask_for_names_of_people)
 
 
-def read_statement(statement, outgoings_column_name, statement_owner, directory):
-    everyone_from_statement = [statement_owner]
+def normalise_description(description):
+    words = re.sub(r"[^a-z ]+", " ", (description or "").lower()).split()
+    return " ".join(words)
 
-    with open(directory + statement, "r") as persons_statement:
-        statement_reader = csv.DictReader(persons_statement)
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class AssignmentHistory:
+    '''Answers given in earlier sessions, keyed by normalised description and offered as the default next time'''
+
+    def __init__(self, path, cache_size=1024, similarity_threshold=0.5):
+        self.path = path
+        self.cache_size = cache_size
+        self.similarity_threshold = similarity_threshold
+        self.answers = {}
+        self._sorted_descriptions = []
+        self._trigrams = {}
+        self._trigram_index = {}
+        self._cache = collections.OrderedDict()
+        if os.path.isfile(path):
+            with open(path, "r") as history_file:
+                for row in csv.DictReader(history_file):
+                    self._index(row["description"], row["payers"])
+
+    def _index(self, description, answer):
+        if description not in self.answers:
+            bisect.insort(self._sorted_descriptions, description)
+            self._trigrams[description] = trigrams(description)
+            for trigram in self._trigrams[description]:
+                self._trigram_index.setdefault(trigram, set()).add(description)
+        self.answers[description] = answer
+
+    def remember(self, description, answer):
+        description = normalise_description(description)
+        if not description or self.answers.get(description) == answer:
+            return
+        self._index(description, answer)
+        # only cached lookups that share a trigram with the new description can have a different answer now
+        new_trigrams = trigrams(description)
+        for cached in [cached for cached in self._cache if trigrams(cached) & new_trigrams]:
+            del self._cache[cached]
+
+    def suggest(self, description):
+        description = normalise_description(description)
+        if not description:
+            return None
+        if description in self._cache:
+            self._cache.move_to_end(description)
+            return self._cache[description]
+        suggestion = self._lookup(description)
+        self._cache[description] = suggestion
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return suggestion
+
+    def _lookup(self, description):
+        if description in self.answers:
+            return self.answers[description]
+        first_word = description.split(" ")[0]
+        start = bisect.bisect_left(self._sorted_descriptions, first_word)
+        end = bisect.bisect_left(self._sorted_descriptions, first_word + "\uffff")
+        candidates = [known for known in self._sorted_descriptions[start:end] if known.split(" ")[0] == first_word]
+
+        query_trigrams = trigrams(description)
+        best = self._most_similar(query_trigrams, candidates)
+        if best is None:
+            # a description sharing enough trigrams to pass the threshold must contain one of the rarest few
+            shared_needed = math.ceil(self.similarity_threshold * len(query_trigrams))
+            rarest = sorted(query_trigrams, key=lambda trigram: len(self._trigram_index.get(trigram, ())))
+            candidates = set().union(*(self._trigram_index.get(trigram, ()) for trigram in rarest[:len(rarest) - shared_needed + 1]))
+            best = self._most_similar(query_trigrams, candidates)
+        return self.answers[best] if best is not None else None
+
+    def _most_similar(self, query_trigrams, candidates):
+        best, best_similarity = None, self.similarity_threshold
+        for known in sorted(candidates):
+            shared = len(query_trigrams & self._trigrams[known])
+            similarity = shared / (len(query_trigrams) + len(self._trigrams[known]) - shared)
+            if similarity >= best_similarity:
+                best, best_similarity = known, similarity
+        return best
+
+    def save(self):
+        with open(self.path, "w") as history_file:
+            writer = csv.DictWriter(history_file, fieldnames=["description", "payers"])
+            writer.writeheader()
+            for description in self._sorted_descriptions:
+                writer.writerow({"description": description, "payers": self.answers[description]})
+
+    def who_should_pay(self, ask=ask_who_should_pay):
+        def assign(transaction, cost):
+            description = transaction.get("Description")
+            people_who_owe = ask(transaction, cost, self.suggest(description))
+            self.remember(description, " ".join(people_who_owe) if people_who_owe else "*SKIP*")
+            return people_who_owe
+        return assign
+
+
+class AssignmentRules:
+    '''Every rule from a rules file compiled into one regex, the first rule that matches a transaction wins'''
+    separator = "\x1f"
+
+    def __init__(self, rules):
+        self.answers = {}
+        alternatives = []
+        for number, rule in enumerate(rules):
+            name = f"rule{number}"
+            self.answers[name] = rule["payers"]
+            fields = [
+                self._glob_to_pattern(rule.get("description") or "*", substring=True),
+                self._glob_to_pattern(rule.get("type") or "*"),
+                re.escape(f"{float(rule['amount']):.2f}") if (rule.get("amount") or "").strip() else self._glob_to_pattern("*")
+            ]
+            alternatives.append(f"(?P<{name}>{re.escape(self.separator).join(fields)})")
+        self.pattern = re.compile("|".join(alternatives), re.IGNORECASE) if alternatives else None
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "r") as rules_file:
+            return cls(list(csv.DictReader(rules_file, skipinitialspace=True)))
+
+    def _glob_to_pattern(self, glob, substring=False):
+        anything = f"[^{self.separator}]*"
+        pattern = anything.join(re.escape(" ".join(part.split())) for part in glob.strip().split("*"))
+        return anything + pattern + anything if substring else pattern
+
+    def match(self, transaction, cost):
+        if self.pattern is None:
+            return None
+        key = self.separator.join([
+            " ".join((transaction.get("Description") or "").split()),
+            (transaction.get("Type") or "").strip(),
+            f"{cost / 100:.2f}"
+        ])
+        matched = self.pattern.fullmatch(key)
+        return self.answers[matched.lastgroup] if matched else None
+
+    def who_should_pay(self, ask=ask_who_should_pay):
+        def assign(transaction, cost):
+            answer = self.match(transaction, cost)
+            if answer is None:
+                return ask(transaction, cost)
+            return people_from_answer(answer)
+        return assign
+
+
+class PrefetchedStatement:
+    '''The start of a statement read, parsed and matched against the rules in the background, while the one before it is being answered'''
+    # only this many transactions are held in memory ahead of time, the rest are read as they are answered
+    rows = 10000
+
+    def __init__(self, statement, bank, transactions, rules=None, rest=()):
+        self.statement = statement
+        self.bank = bank
+        self.transactions = transactions
+        self.rest = rest
+        self.rules = rules
+        self._matches = {id(transaction): rules.match(transaction, cost) for _, transaction, cost in transactions} if rules is not None else {}
+
+    @classmethod
+    def load(cls, statement, directory, rules=None, answers_index=None, rows=None):
+        answers = answers_index.answers_for(statement) if answers_index is not None else None
+        bank = known_bank(answers.answer_for("bank")) if answers is not None else None
+        if bank is None:
+            bank = detect_bank(directory + statement)
+        if bank is None:
+            # the bank has to be asked for, so the statement is read once it's known
+            return None
+        bank_format = BANK_FORMATS[bank]
+        transactions = iter_statement(directory + statement, bank_format["outgoings"], bank_format)
+        return cls(statement, bank, list(itertools.islice(transactions, rows or cls.rows)), rules, transactions)
+
+    def iter_transactions(self):
+        return itertools.chain(self.transactions, self.rest)
+
+    def match(self, transaction, cost):
+        key = id(transaction)
+        if key in self._matches:
+            return self._matches[key]
+        return self.rules.match(transaction, cost) if self.rules is not None else None
+
+    who_should_pay = AssignmentRules.who_should_pay
+
+
+def iter_prefetched(statements, prepare):
+    # prepare(statement) for the next statement runs on another thread while the caller works on the current one
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        upcoming = pool.submit(prepare, statements[0]) if statements else None
+        for number, statement in enumerate(statements):
+            current = upcoming
+            upcoming = pool.submit(prepare, statements[number + 1]) if number + 1 < len(statements) else None
+            yield statement, current.result()
+
+
+def short_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little")
+
+
+def transaction_key(transaction, cost, statement_owner):
+    date = (transaction.get("Date") or "").strip()
+    return short_hash(f"{date}\x1f{normalise_description(transaction.get('Description'))}\x1f{cost}\x1f{statement_owner.lower()}")
+
+
+class TransactionIndex:
+    '''Every transaction seen in any statement, so the same transaction exported in two statements is only counted once'''
+    record = numpy.dtype([("key", "<u8"), ("statement", "<u8")])
+    number_of_hashes = 4
+
+    def __init__(self, path, bits_per_transaction=10):
+        self.path = path
+        if os.path.isfile(path) and os.path.getsize(path) % self.record.itemsize:
+            # a record cut short when a run stopped is dropped, so the records appended after it line up
+            os.truncate(path, os.path.getsize(path) - os.path.getsize(path) % self.record.itemsize)
+        records = numpy.fromfile(path, dtype=self.record) if os.path.isfile(path) else numpy.zeros(0, dtype=self.record)
+        self._records = numpy.sort(records, order="key")
+        self._seen_this_run = {}
+        self._pending = []
+        # a Bloom filter in front of the records, so most new transactions are never looked up
+        self._bits = max(1 << 16, 1 << (bits_per_transaction * len(records)).bit_length())
+        keys = self._records["key"]
+        hashes = numpy.arange(self.number_of_hashes, dtype=numpy.uint64)
+        positions = ((keys & 0xffffffff)[:, None] + hashes * ((keys >> numpy.uint64(32)) | numpy.uint64(1))[:, None]) & numpy.uint64(self._bits - 1)
+        bloom = numpy.zeros(self._bits // 8, dtype=numpy.uint8)
+        numpy.bitwise_or.at(bloom, (positions >> numpy.uint64(3)).ravel(), (numpy.uint8(1) << (positions & numpy.uint64(7)).astype(numpy.uint8)).ravel())
+        self._bloom = bytearray(bloom.tobytes())
+
+    def _positions(self, key):
+        low, high = key & 0xffffffff, (key >> 32) | 1
+        return [(low + number * high) & (self._bits - 1) for number in range(self.number_of_hashes)]
+
+    def _statements_with(self, key):
+        start = numpy.searchsorted(self._records["key"], numpy.uint64(key), side="left")
+        end = numpy.searchsorted(self._records["key"], numpy.uint64(key), side="right")
+        return set(self._records["statement"][start:end].tolist()) | self._seen_this_run.get(key, set())
+
+    def might_contain(self, key):
+        return all(self._bloom[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def is_duplicate(self, key, statement):
+        if not self.might_contain(key):
+            return False
+        return bool(self._statements_with(key) - {short_hash(statement)})
+
+    def add(self, key, statement):
+        statement_hash = short_hash(statement)
+        if self.might_contain(key) and statement_hash in self._statements_with(key):
+            return
+        self._pending.append((key, statement_hash))
+        self._seen_this_run.setdefault(key, set()).add(statement_hash)
+        for position in self._positions(key):
+            self._bloom[position >> 3] |= 1 << (position & 7)
+
+    def save(self):
+        with open(self.path, "ab") as index_file:
+            index_file.write(numpy.array(self._pending, dtype=self.record).tobytes())
+        self._pending = []
+
+
+def iter_unseen_transactions(chargeable_transactions, seen, statement, statement_owner):
+    for row_number, transaction, cost in chargeable_transactions:
+        key = transaction_key(transaction, cost, statement_owner)
+        if seen.is_duplicate(key, statement):
+            print(f"Skipping a transaction that is already in another statement: {transaction}")
+            if PROFILE is not None:
+                PROFILE.add("read_statement", "rows_duplicated")
+            continue
+        seen.add(key, statement)
+        yield row_number, transaction, cost
+
+
+def iter_assignments(chargeable_transactions, who_should_pay, answers=None, journal=None, statement=None):
+    for row_number, transaction, cost in chargeable_transactions:
+        answer = answers.answer_for(row_number) if answers is not None else None
+        if answer is not None:
+            people_who_owe = people_from_answer(answer)
+        else:
+            people_who_owe = who_should_pay(transaction, cost)
+            if journal is not None:
+                journal.append(statement, row_number, " ".join(people_who_owe) if people_who_owe else "*SKIP*")
+        if people_who_owe:
+            yield row_number, transaction, cost, people_who_owe
+        elif PROFILE is not None:
+            PROFILE.add("read_statement", "rows_skipped")
+
+
+def iter_grouped_assignments(chargeable_transactions, who_should_pay, rules=None, answers=None):
+    groups = {}
+    for row_number, transaction, cost in chargeable_transactions:
+        answer = answers.answer_for(row_number) if answers is not None else None
+        if answer is None and rules is not None:
+            answer = rules.match(transaction, cost)
+        if answer is not None:
+            people_who_owe = people_from_answer(answer)
+            if people_who_owe:
+                yield row_number, transaction, cost, people_who_owe
+            continue
+        description = normalise_description(transaction.get("Description"))
+        if description not in groups:
+            groups[description] = [row_number, transaction.get("Description"), 0, 0]
+        groups[description][2] += 1
+        groups[description][3] += cost
+
+    for row_number, description, count, total in groups.values():
+        group = {"Description": description, "Transactions": count, "Total": f"{total / 100:.2f}"}
+        people_who_owe = who_should_pay(group, total)
+        if people_who_owe:
+            yield row_number, group, total, people_who_owe
+
+
+def iter_recorded(assignments, record):
+    for assignment in assignments:
+        record(assignment)
+        yield assignment
+
+
+def aggregate_owes(assignments, statement_owner):
+    # transactions split between the same people are summed, and only split once the statement has been read,
+    # so the leftover pennies are shared out across the statement, the same as iter_split_assignments does
+    splits = {}
+    # a dict rather than a set so the totals header keeps the order people first appeared in
+    everyone_from_statement = {statement_owner: None}
+    for _, _, cost, people_who_owe in assignments:
+        people = tuple(people_who_owe)
+        if people not in splits:
+            splits[people] = 0
+            everyone_from_statement.update(dict.fromkeys(people))
+        splits[people] += cost
+
+    owes_from_statement = {"owes": statement_owner, statement_owner: 0}
+    owner = statement_owner.lower()
+    for people, pence in splits.items():
+        for person, share in zip(people, split_pence(pence, len(people)).tolist()):
+            owes_from_statement.setdefault(person, 0)
+            if person.lower() != owner:
+                owes_from_statement[person] += share
+    return owes_from_statement, list(everyone_from_statement)
+
+
+@profiled("read_statement")
+def read_statement(statement, outgoings_column_name, statement_owner, directory, rules=None, history=None, group=False, ask=ask_who_should_pay, answers=None, seen=None, record=None, bank_format=None, prefetched=None, journal=None):
+    who_should_pay = ask
+    if history is not None:
+        who_should_pay = history.who_should_pay(who_should_pay)
+    if PROFILE is not None:
+        PROFILE.add("read_statement", "bytes_read", statement_size(directory + statement))
+    if ask is ask_who_should_pay:
         print(f"For each transaction in {statement} enter the name of everyone who should pay for this item. Remember to include your name.") 
         print("TYPE '*SKIP*' to skip a transaction.")
-        owes_from_statement = {"owes": statement_owner, statement_owner: 0.0}
-        for transaction in statement_reader:
-            try:
-                cost = float(transaction[outgoings_column_name])
-                price = re.search("[0-9.]+", transaction[outgoings_column_name])
-                cost = float(price.group())
-            except TypeError and ValueError:
+    if prefetched is not None:
+        transactions = prefetched.iter_transactions()
+        if rules is not None:
+            rules = prefetched
+    else:
+        transactions = iter_statement(directory + statement, outgoings_column_name, bank_format)
+    if seen is not None:
+        transactions = iter_unseen_transactions(transactions, seen, statement, statement_owner)
+    if group:
+        assignments = iter_grouped_assignments(transactions, who_should_pay, rules, answers)
+    else:
+        if rules is not None:
+            who_should_pay = rules.who_should_pay(who_should_pay)
+        assignments = iter_assignments(transactions, who_should_pay, answers, journal, statement)
+    if record is not None:
+        assignments = iter_recorded(assignments, record)
+    return aggregate_owes(assignments, statement_owner)
+
+
+def refuse_to_ask(transaction, cost, suggestion=None):
+    raise ValueError(f"Nothing says who should pay for this transaction and no one can be asked in batch mode: {transaction}")
+
+
+def split_statement_in_batch(job):
+    statement, bank_format, statement_owner, directory, rules, answers_file, answer_ranges, keep_assignments = job
+    answers = StatementAnswers(answers_file, statement, ranges=answer_ranges) if answers_file else None
+    assignments = [] if keep_assignments else None
+    owed_from_statement, names = read_statement(statement, bank_format["outgoings"], statement_owner, directory, rules, ask=refuse_to_ask, answers=answers, record=assignments.append if keep_assignments else None, bank_format=bank_format)
+    return owed_from_statement, names, assignments
+
+
+@profiled("triage_statements_in_parallel")
+def triage_statements_in_parallel(statements, directory, ledger, rules, workers, answers_index=None, manifest=None, database=None, periods=None):
+    cached = {}
+    jobs = []
+    for statement in statements:
+        cached[statement] = manifest.cached(statement) if manifest is not None and (periods is None or statement in periods.statements) else None
+        if cached[statement] is None:
+            answers = answers_index.answers_for(statement) if answers_index is not None else None
+            person = whose_statement(statement, answers)
+            bank = which_bank(statement, directory, answers)
+            # workers are only sent where this statement's answers are, not the whole index
+            answers_file, answer_ranges = (answers.path, answers.ranges) if answers is not None else (None, None)
+            jobs.append((statement, BANK_FORMATS[bank], person, directory, rules, answers_file, answer_ranges, database is not None or periods is not None))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        # map returns results in job order, so the totals come out the same as a sequential run
+        results = zip(jobs, pool.map(split_statement_in_batch, jobs))
+        for statement in statements:
+            if cached[statement] is not None:
+                ledger.apply(cached[statement]["owner"], cached[statement]["names"], cached[statement]["owes"])
                 continue
-            print(f"\n{transaction}\n")
-            ask_for_names_of_people = input("Including yourself, list the people who should pay for this transaction: ")
-            if ask_for_names_of_people.strip() == '*SKIP*':
-                continue 
-            list_of_names_unformatted = ask_for_names_of_people.split(" ")
-            people_who_owe = [person.capitalize() for person in list_of_names_unformatted if person != ""]
-            how_much_each_person_owes = round(cost / len(people_who_owe), 2)
-
-            for person in people_who_owe:
-                if person not in owes_from_statement: owes_from_statement[person] = 0.0
-                if person.lower() != statement_owner.lower():
-                    owes_from_statement[person] = round(owes_from_statement[person] + how_much_each_person_owes, 2)
-            everyone_from_statement += people_who_owe
-    return owes_from_statement, everyone_from_statement
+            (_, bank_format, person, *_), (owed_from_statement, names, assignments) = next(results)
+            ledger.apply(person, names, owed_from_statement)
+            if database is not None:
+                database.add_statement(statement, person, names, assignments)
+            if periods is not None:
+                periods.add_statement(statement, person, assignments)
+            if manifest is not None:
+                manifest.record(statement, person, bank_format["name"], owed_from_statement, names)
 
 
+@profiled("merge_owed_from_statement_with_totals")
 def merge_owed_from_statement_with_totals(directory, names_from_statement, statement_owner, name_of_totals_spreadsheet, owed_from_current_statement):
-    header = []
-    with open(directory + name_of_totals_spreadsheet, "r") as read_totals:
-        totals_csv_object = csv.DictReader(read_totals)
-        header = list(totals_csv_object.fieldnames)
-        for name in names_from_statement:
-            if name not in header:
-                header.append(name)
-
-        totals_spreadsheet = convert_all_values_to_floats(list(totals_csv_object))
-        people_who_owe_from_statement = list(owed_from_current_statement.keys())
-        people_who_owe_from_statement.remove("owes")
-        people_already_owed = []
-        
-        for row in totals_spreadsheet:
-            people_already_owed.append(row["owes"])
-            for name in names_from_statement:
-                if name not in row:
-                    row[name] = 0.0
-            if row['owes'] == statement_owner:
-                for person in people_who_owe_from_statement:
-                    try:
-                        row[person] += float(owed_from_current_statement[person])
-                    except ValueError:
-                        row[person] += float(owed_from_current_statement[person])
+    ledger = Ledger.from_totals_file(directory, name_of_totals_spreadsheet)
+    ledger.apply(statement_owner, names_from_statement, owed_from_current_statement)
+    return ledger.rows, ledger.header
+
+
+@contextlib.contextmanager
+def atomic_write(path):
+    # written to a hidden temporary file next to it, then renamed over it, so no one ever reads a half written file
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".", suffix=".tmp")
+    try:
+        os.chmod(temporary_path, stat.S_IMODE(os.stat(path).st_mode) if os.path.exists(path) else 0o644)
+        with os.fdopen(file_descriptor, "w") as temporary_file:
+            yield temporary_file
+            temporary_file.flush()
+            os.fsync(temporary_file.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+@contextlib.contextmanager
+def locked(path):
+    # an advisory lock, everyone sharing the totals takes it before changing them
+    import fcntl
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class SharedTotals:
+    '''What each session added to the totals kept in a file of its own, so several people can split statements into the same totals at once'''
 
-        
-        if statement_owner not in people_already_owed:
-            for person in header:
-                if person not in owed_from_current_statement and person != 'owes':
-                    owed_from_current_statement[person] = 0.0
-            totals_spreadsheet.append(owed_from_current_statement)
-            
-        return totals_spreadsheet, header
+    def __init__(self, directory, totals_spreadsheet, session):
+        self.directory = directory
+        self.totals_spreadsheet = totals_spreadsheet
+        self.session = session
+        self.sessions_directory = directory + totals_spreadsheet[:-4] + ".sessions/"
+        self.lock_path = directory + totals_spreadsheet[:-4] + ".lock"
+        os.makedirs(self.sessions_directory, exist_ok=True)
+        self.statements = self._read(self.session).get("statements", {})
 
+    def _path(self, session):
+        return self.sessions_directory + session + ".json"
 
+    def _read(self, session):
+        try:
+            with open(self._path(session), "r") as session_file:
+                return json.load(session_file)
+        except FileNotFoundError:
+            return {}
+
+    def _read_sessions(self):
+        sessions = {self.session: self.statements}
+        for entry in os.scandir(self.sessions_directory):
+            session = entry.name[:-len(".json")]
+            if entry.name.endswith(".json") and session != self.session:
+                sessions[session] = self._read(session).get("statements", {})
+        return sessions
+
+    def _save(self):
+        with atomic_write(self._path(self.session)) as session_file:
+            json.dump({"session": self.session, "statements": self.statements}, session_file)
+
+    def claim(self, statement):
+        # a statement is split by the first session to claim it, or again by the same session if it stopped part way through
+        with locked(self.lock_path):
+            for session, statements in self._read_sessions().items():
+                entry = statements.get(statement)
+                if entry is not None and (session != self.session or entry["owes"] is not None):
+                    return False
+            self.statements[statement] = {"owner": None, "bank": None, "owes": None, "names": []}
+            self._save()
+            return True
+
+    def record(self, statement, statement_owner, bank, owed_from_statement, names):
+        self.statements[statement] = {"owner": statement_owner, "bank": bank, "owes": owed_from_statement, "names": names}
+        with locked(self.lock_path):
+            self._save()
+        return self.merge()
+
+    def merge(self):
+        # the totals are always the sum of every session, in statement order, so they come out the same whoever merges last
+        with locked(self.lock_path):
+            entries = sorted((statement, entry) for statements in self._read_sessions().values() for statement, entry in statements.items() if entry["owes"] is not None)
+            ledger = Ledger(self.directory, self.totals_spreadsheet)
+            for _, entry in entries:
+                ledger.apply(entry["owner"], entry["names"], entry["owes"])
+            ledger.flush()
+        return ledger
+
+
+@profiled("write_to_totals_spreadsheet")
 def write_to_totals_spreadsheet(directory, header, totals_spreadsheet, new_total_owed):
-    with open(directory + totals_spreadsheet, "w") as t:
+    with atomic_write(directory + totals_spreadsheet) as t:
         writer = csv.DictWriter(t,fieldnames=header)
         writer.writeheader()
         for row in new_total_owed:
             writer.writerow(row)
+        if PROFILE is not None:
+            PROFILE.add("write_to_totals_spreadsheet", "bytes_written", t.tell())
+
+def write_html_table(html, header, rows):
+    html.write('<table border="1" class="dataframe">\n  <thead>\n    <tr style="text-align: right;">\n      <th></th>\n')
+    for name in header:
+        html.write(f"      <th>{escape(str(name))}</th>\n")
+    html.write("    </tr>\n  </thead>\n  <tbody>\n")
+    for number, row in enumerate(rows):
+        html.write(f"    <tr>\n      <th>{number}</th>\n")
+        for name in header:
+            html.write(f"      <td>{escape(str(row.get(name, '')))}</td>\n")
+        html.write("    </tr>\n")
+    html.write("  </tbody>\n</table>")
+
+
+def write_period_tables(html, periods, period):
+    for name, start, end in periods.periods(period):
+        header, rows = periods.owed_between(start, end)
+        html.write(f"\n<h2>{escape(name)}</h2>\n")
+        write_html_table(html, header, rows)
 
-def create_table_in_html_file(folder, new_totals_spreadsheet):
-    totals_csv = pandas.read_csv(folder + new_totals_spreadsheet)
+
+@profiled("create_table_in_html_file")
+def create_table_in_html_file(folder, new_totals_spreadsheet, ledger=None, rich=False, periods=None, period="month"):
     name_of_html = new_totals_spreadsheet[:-3] + 'html'
-    totals_csv.to_html(folder + name_of_html)
+    if rich:
+        import pandas
+        totals_csv = pandas.read_csv(folder + new_totals_spreadsheet)
+        totals_csv.to_html(folder + name_of_html)
+        if periods is not None:
+            with open(folder + name_of_html, "a") as html:
+                write_period_tables(html, periods, period)
+        return name_of_html
+
+    with open(folder + name_of_html, "w") as html:
+        if ledger is not None:
+            write_html_table(html, ledger.header, ledger.rows)
+        else:
+            with open(folder + new_totals_spreadsheet, "r") as totals:
+                totals_csv_object = csv.DictReader(totals)
+                write_html_table(html, totals_csv_object.fieldnames or [], totals_csv_object)
+        if periods is not None:
+            write_period_tables(html, periods, period)
+        if PROFILE is not None:
+            PROFILE.add("create_table_in_html_file", "bytes_written", html.tell())
     return name_of_html
 
 
-def main():
-    folder = find_folder()
-    new_totals_spreadsheet = create_totals_file(folder)
-    statements = get_statements(folder, new_totals_spreadsheet)
-    for statement in statements:
-        if statement != new_totals_spreadsheet:
-            person, outgoings_column_name = whose_statement_and_which_bank(statement)
-            triage_transactions(statement, outgoings_column_name, folder, person, new_totals_spreadsheet)
-    
-    html_file = create_table_in_html_file(folder, new_totals_spreadsheet)
+class RecordedAnswers:
+    '''Answers given to the server, looked up the same way as an answers file'''
+
+    def __init__(self, answers=None):
+        self.answers = {str(row): answer for row, answer in (answers or {}).items()}
+
+    def answer_for(self, row):
+        return self.answers.get(str(row))
+
+
+class CalculatorService:
+    '''The ledger, bank formats and rules kept in memory between requests, statements are uploaded and answered over HTTP'''
+
+    def __init__(self, directory, totals_spreadsheet, ledger, rules=None, journal=None, triage=None, update=None):
+        self.directory = directory
+        self.totals_spreadsheet = totals_spreadsheet
+        self.ledger = ledger
+        self.rules = rules
+        self.journal = journal
+        # main passes its own, so answered statements go in the manifest, dedupe index and history like any other
+        self.triage = triage
+        self.update = update
+        self.pending = {}
+        self._lock = threading.Lock()
+
+    def upload(self, statement, owner, data, bank=None):
+        if os.path.basename(statement) != statement or not statement.endswith(".csv"):
+            raise ValueError(f"Statements are uploaded as a .csv file name without a folder, not '{statement}'")
+        if not owner:
+            raise ValueError("Say whose statement it is with ?owner=")
+        with self._lock:
+            if statement in self.pending or os.path.exists(self.directory + statement):
+                raise ValueError(f"{statement} has already been uploaded")
+            with open(self.directory + statement, "wb") as statement_file:
+                statement_file.write(data)
+            bank = known_bank(bank) if bank else detect_bank(self.directory + statement)
+            if bank is None:
+                os.remove(self.directory + statement)
+                raise ValueError(f"The bank {statement} is from isn't known, say which it is with ?bank=")
+            if self.journal is not None:
+                self.journal.append(statement, "owner", owner)
+                self.journal.append(statement, "bank", bank)
+            bank_format = BANK_FORMATS[bank]
+            unanswered = {}
+            for row_number, transaction, cost in iter_statement(self.directory + statement, bank_format["outgoings"], bank_format):
+                if self.rules is None or self.rules.match(transaction, cost) is None:
+                    unanswered[str(row_number)] = {"row": row_number, "transaction": transaction, "cost": f"{cost / 100:.2f}"}
+            self.pending[statement] = {"owner": owner, "bank": bank, "unanswered": unanswered, "answers": {}}
+            try:
+                return self._apply_when_answered(statement)
+            except Exception:
+                # a statement that can't be added is forgotten, so it can be uploaded again
+                del self.pending[statement]
+                os.remove(self.directory + statement)
+                raise
+
+    def answer(self, statement, answers):
+        with self._lock:
+            if statement not in self.pending:
+                raise KeyError(statement)
+            pending = self.pending[statement]
+            # every answer is checked before any is used, so a bad request leaves the statement as it was
+            if not isinstance(answers, dict):
+                raise ValueError("Answers are sent as a JSON object of row number to answer")
+            for row, answer in answers.items():
+                if str(row) not in pending["unanswered"]:
+                    raise ValueError(f"Row {row} of {statement} isn't waiting for an answer")
+                if not isinstance(answer, str) or not answer.strip():
+                    raise ValueError(f"The answer for row {row} of {statement} should be the names of who should pay, or *SKIP*")
+            unanswered, given = dict(pending["unanswered"]), dict(pending["answers"])
+            for row, answer in answers.items():
+                pending["answers"][str(row)] = answer
+                del pending["unanswered"][str(row)]
+                if self.journal is not None:
+                    self.journal.append(statement, str(row), answer)
+            try:
+                return self._apply_when_answered(statement)
+            except Exception:
+                pending["unanswered"], pending["answers"] = unanswered, given
+                raise
+
+    def _apply_when_answered(self, statement):
+        pending = self.pending[statement]
+        if pending["unanswered"]:
+            return {"statement": statement, "applied": False, "unanswered": list(pending["unanswered"].values())}
+        answers = RecordedAnswers(dict(pending["answers"], owner=pending["owner"], bank=pending["bank"]))
+        if self.triage is not None:
+            self.triage(statement, answers=answers, ask=refuse_to_ask)
+        else:
+            bank_format = BANK_FORMATS[pending["bank"]]
+            owed_from_statement, names = read_statement(statement, bank_format["outgoings"], pending["owner"], self.directory, self.rules, ask=refuse_to_ask, answers=answers, bank_format=bank_format)
+            self.ledger.apply(pending["owner"], names, owed_from_statement)
+        if self.update is not None:
+            self.update()
+        else:
+            self.ledger.flush()
+        del self.pending[statement]
+        return {"statement": statement, "applied": True, "unanswered": []}
+
+    def statements(self):
+        with self._lock:
+            return [{"statement": statement, "owner": pending["owner"], "bank": pending["bank"], "unanswered": list(pending["unanswered"].values())} for statement, pending in self.pending.items()]
+
+    def totals(self):
+        with self._lock:
+            return {"header": self.ledger.header, "rows": self.ledger.rows}
+
+    def html(self):
+        with self._lock:
+            html = io.StringIO()
+            write_html_table(html, self.ledger.header, self.ledger.rows)
+            return html.getvalue()
+
+    def settle_up(self):
+        with self._lock:
+            return [{"payer": payer, "payee": payee, "amount": f"{pence_to_pounds(pence):.2f}"} for payer, payee, pence in settle_up(self.ledger.balances())]
+
+
+class CalculatorRequests:
+    '''GET /totals, /totals.html, /settle-up and /statements, POST /statements/<name>?owner=&bank= and /statements/<name>/answers'''
+
+    def do_GET(self):
+        service = self.server.service
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/totals":
+            self.send(200, service.totals())
+        elif path == "/totals.html":
+            self.send(200, service.html(), "text/html; charset=utf-8")
+        elif path == "/settle-up":
+            self.send(200, service.settle_up())
+        elif path == "/statements":
+            self.send(200, service.statements())
+        else:
+            self.send(404, {"error": f"Nothing at {path}"})
+
+    def do_POST(self):
+        service = self.server.service
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        parts = [urllib.parse.unquote(part) for part in url.path.strip("/").split("/")]
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            if len(parts) == 2 and parts[0] == "statements":
+                self.send(201, service.upload(parts[1], query.get("owner"), body, query.get("bank")))
+            elif len(parts) == 3 and parts[0] == "statements" and parts[2] == "answers":
+                self.send(200, service.answer(parts[1], json.loads(body or b"{}")))
+            else:
+                self.send(404, {"error": f"Nothing at {url.path}"})
+        except KeyError as missing:
+            self.send(404, {"error": f"{missing.args[0]} isn't waiting for answers"})
+        except ValueError as error:
+            self.send(400, {"error": str(error)})
+
+    def send(self, status, content, content_type="application/json"):
+        body = (content if isinstance(content, str) else json.dumps(content)).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(service, port=0):
+    # http.server is only imported when serving, like pandas for --rich-report, so it doesn't slow down starting up
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    handler = type("CalculatorRequestHandler", (CalculatorRequests, BaseHTTPRequestHandler), {})
+    # only listens on this computer, port 0 picks any free port
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.service = service
+    return server
+
+
+class FolderWatcher:
+    '''Finds statements that are new or have changed in a folder, woken by inotify where there is one, otherwise by polling'''
+    # IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE and IN_DELETE
+    inotify_mask = 0x8 | 0x80 | 0x100 | 0x200
+
+    def __init__(self, folder, ignore=(), interval=1.0, use_inotify=True):
+        self.folder = folder
+        self.ignore = set(ignore)
+        self.interval = interval
+        self.snapshot = self.scan()
+        self._settling = {}
+        self._inotify = self._open_inotify() if use_inotify else None
+
+    def scan(self):
+        snapshot = {}
+        for statement in iter_statement_files(self.folder):
+            if statement in self.ignore:
+                continue
+            try:
+                status = os.stat(split_archive_path(self.folder + statement)[0])
+            except FileNotFoundError:
+                continue
+            snapshot[statement] = (status.st_size, status.st_mtime_ns)
+        return snapshot
+
+    def _open_inotify(self):
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            file_descriptor = libc.inotify_init1(os.O_NONBLOCK)
+        except (OSError, AttributeError):
+            return None
+        if file_descriptor < 0:
+            return None
+        self._libc = libc
+        self._watch_directories(file_descriptor)
+        return file_descriptor
+
+    def _watch_directories(self, file_descriptor):
+        # watching a directory that is already watched is a no-op, so new sub-directories are picked up each time
+        for directory, subdirectories, _ in os.walk(self.folder):
+            subdirectories[:] = [subdirectory for subdirectory in subdirectories if not subdirectory.startswith(".")]
+            self._libc.inotify_add_watch(file_descriptor, os.fsencode(directory), self.inotify_mask)
+
+    def wait(self):
+        if self._inotify is None:
+            time.sleep(self.interval)
+            return
+        # wakes as soon as something is written, or after the interval so settling files are checked again
+        ready, _, _ = select.select([self._inotify], [], [], self.interval)
+        if ready:
+            while True:
+                try:
+                    os.read(self._inotify, 65536)
+                except BlockingIOError:
+                    break
+            self._watch_directories(self._inotify)
+
+    def changes(self):
+        # a statement is only reported once it is the same size and age on two scans in a row, so it has finished being written
+        current = self.scan()
+        ready = []
+        for statement, signature in current.items():
+            if self.snapshot.get(statement) == signature:
+                self._settling.pop(statement, None)
+            elif self._settling.get(statement) == signature:
+                ready.append(statement)
+                self.snapshot[statement] = signature
+                del self._settling[statement]
+            else:
+                self._settling[statement] = signature
+        for statement in set(self.snapshot) - set(current):
+            del self.snapshot[statement]
+        return sorted(ready)
+
+    def close(self):
+        if self._inotify is not None:
+            os.close(self._inotify)
+            self._inotify = None
+
+
+def watch_statements(watcher, ingest, update):
+    print(f"Watching {watcher.folder} for new or changed statements, press Ctrl+C to stop.")
+    try:
+        while True:
+            watcher.wait()
+            changed = [statement for statement in watcher.changes() if ingest(statement)]
+            if changed:
+                update()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def serve(service, port):
+    server = start_server(service, port)
+    print(f"Serving the totals on http://127.0.0.1:{server.server_address[1]}/totals, press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Work out who owes whom what from a folder of bank statements.")
+    parser.add_argument("--banks", help="JSON file of extra bank formats, each with its header, outgoings column, sign, date format and column names")
+    parser.add_argument("--rules", help="CSV of description, type, amount and payers used to assign transactions without asking")
+    parser.add_argument("--history", help="CSV of past answers, offered as the default for similar transactions and updated at the end of the run")
+    parser.add_argument("--group", action="store_true", help="ask once for every transaction with the same description instead of once per transaction")
+    parser.add_argument("--answers", help="CSV or JSONL of statement, row and answer used instead of asking. The row is 'owner', 'bank' or the number of the transaction in the statement")
+    parser.add_argument("--rich-report", action="store_true", help="build the HTML table with pandas instead of the built in writer")
+    parser.add_argument("--incremental", action="store_true", help="reuse what unchanged statements added last time, from a manifest saved next to the totals")
+    parser.add_argument("--dedupe", action="store_true", help="skip transactions already counted from another statement, using an index saved next to the totals")
+    parser.add_argument("--database", help="SQLite file that keeps every transaction and who paid for it, the totals are worked out from everything in it")
+    parser.add_argument("--batch", action="store_true", help="split statements in parallel without asking about transactions, needs --rules or --answers")
+    parser.add_argument("--profile", action="store_true", help="save the time, rows, prompts, bytes and peak memory of each stage to a JSON report next to the totals")
+    parser.add_argument("--prefetch", action="store_true", help="read the next statement in the background while this one is being answered, and save the totals after each statement without waiting")
+    parser.add_argument("--journal", help="JSONL file every answer is appended to as it is given, see --resume")
+    parser.add_argument("--resume", action="store_true", help="carry on from the --journal of a run that stopped, only asking about what it hadn't answered")
+    parser.add_argument("--overwrite-journal", action="store_true", help="start the --journal again even if it already has answers in it")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="after reading the statements, keep the totals in memory and serve them on http://127.0.0.1:PORT/, where more statements can be uploaded and answered")
+    parser.add_argument("--watch", type=float, nargs="?", const=1.0, metavar="SECONDS", help="after reading the statements, keep watching the folder and add statements as they arrive or change, checking at least every SECONDS")
+    parser.add_argument("--session", help="split statements at the same time as other people, each with their own session name, adding to the same totals")
+    parser.add_argument("--periods", choices=list(PERIOD_LABELS), help="keep who owed whom on each day in an index next to the totals, and add a table for each day, month, quarter or year to the HTML")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of processes used by --batch")
+    arguments = parser.parse_args(argv)
+    if arguments.batch and not (arguments.rules or arguments.answers):
+        parser.error("--batch needs --rules or --answers to know who should pay for each transaction")
+    if arguments.batch and arguments.dedupe:
+        parser.error("--dedupe needs statements to be read one after another, so it can't be used with --batch")
+    if arguments.batch and arguments.prefetch:
+        parser.error("--batch already reads statements in parallel, so it can't be used with --prefetch")
+    if arguments.watch is not None and (arguments.serve is not None or arguments.database):
+        parser.error("--watch can't be used with --serve or --database")
+    if arguments.serve is not None and (arguments.database or arguments.group):
+        parser.error("--serve keeps the totals in memory and asks about single transactions, so it can't be used with --database or --group")
+    if arguments.watch is not None:
+        # what each statement added is needed to replace it when it changes
+        arguments.incremental = True
+    if arguments.database and arguments.incremental:
+        parser.error("--database works the totals out from every transaction in it, so it can't be used with --incremental, which doesn't read unchanged statements into it")
+    if arguments.session and (arguments.batch or arguments.database or arguments.incremental or arguments.watch is not None or arguments.serve is not None):
+        parser.error("--session can't be used with --batch, --database, --incremental, --watch or --serve")
+    if arguments.session is not None and (not arguments.session or os.path.basename(arguments.session) != arguments.session or arguments.session.startswith(".")):
+        parser.error("--session needs a name that can be used as a file name")
+    if arguments.periods and (arguments.group or arguments.session or arguments.serve is not None):
+        parser.error("--periods needs the date of every transaction from this run, so it can't be used with --group, --session or --serve")
+    if arguments.resume and not arguments.journal:
+        parser.error("--resume needs the --journal of the run to carry on from")
+    if arguments.journal and (arguments.batch or arguments.group):
+        parser.error("--journal records answers to single transactions as they are asked, so it can't be used with --batch or --group")
+    if arguments.resume and arguments.overwrite_journal:
+        parser.error("--resume carries on from the answers in the --journal, so it can't be used with --overwrite-journal")
+    if arguments.journal and not (arguments.resume or arguments.overwrite_journal) and os.path.exists(arguments.journal) and os.path.getsize(arguments.journal):
+        parser.error(f"{arguments.journal} already has answers in it, use --resume to carry on from them or --overwrite-journal to start again")
+    return arguments
+
+
+def save_and_report(folder, new_totals_spreadsheet, ledger, manifest=None, seen=None, history=None, rich=False, periods=None, period="month"):
+    if manifest is not None:
+        manifest.save()
+    if periods is not None:
+        periods.save(folder + new_totals_spreadsheet[:-4] + ".periods.json")
+    if seen is not None:
+        seen.save()
+    if history is not None:
+        history.save()
+
+    html_file = create_table_in_html_file(folder, new_totals_spreadsheet, ledger, rich, periods, period)
+    transfers = settle_up(ledger.balances())
+    if transfers:
+        print("To settle up:")
+        for payer, payee, pence in transfers:
+            print(f" - {payer} pays {payee} {pence_to_pounds(pence):.2f}")
     print(f'You can view a table of who owes whom what, by opening {folder}{html_file} in a web browser.')
 
+
+def main(argv=()):
+    global PROFILE
+    arguments = parse_arguments(argv)
+    PROFILE = Profile() if arguments.profile else None
+    if arguments.banks:
+        load_bank_formats(arguments.banks)
+    rules = AssignmentRules.from_file(arguments.rules) if arguments.rules else None
+    history = AssignmentHistory(arguments.history) if arguments.history else None
+    folder = find_folder()
+    # a session adds to the totals other people are working on, so they aren't emptied first
+    new_totals_spreadsheet = create_totals_file(folder, reset=not arguments.session)
+    shared = SharedTotals(folder, new_totals_spreadsheet, arguments.session) if arguments.session else None
+    writer = BackgroundWriter() if arguments.prefetch else None
+    # without --resume the journal starts empty, so answers from an older run are never replayed
+    journal = Journal(arguments.journal, arguments.resume, arguments.overwrite_journal) if arguments.journal else None
+    # each answers file is read through once here, then each statement only reads its own answers from it
+    answers_index = AnswersIndex(arguments.answers) if arguments.answers else None
+    journal_index = AnswersIndex(arguments.journal) if arguments.resume else None
+
+    def answers_for(statement):
+        answers = answers_index.answers_for(statement) if answers_index is not None else None
+        if journal_index is not None:
+            answers = journal_index.answers_for(statement, answers)
+        return answers
+
+    if shared is not None:
+        ledger = Ledger(folder, new_totals_spreadsheet)
+    else:
+        ledger = Ledger.from_totals_file(folder, new_totals_spreadsheet, 1 if arguments.prefetch else 0, writer)
+    manifest = StatementManifest(folder, new_totals_spreadsheet) if arguments.incremental else None
+    database = LedgerDatabase(arguments.database) if arguments.database else None
+    periods_path = folder + new_totals_spreadsheet[:-4] + ".periods.json"
+    # statements that haven't changed keep their days from last time, like their totals in the manifest
+    periods = (PeriodIndex.load(periods_path) if arguments.incremental else PeriodIndex()) if arguments.periods else None
+    seen = TransactionIndex(folder + new_totals_spreadsheet[:-4] + ".transactions.idx") if arguments.dedupe else None
+    outputs = {new_totals_spreadsheet, new_totals_spreadsheet[:-3] + 'html', new_totals_spreadsheet[:-4] + ".manifest.json", new_totals_spreadsheet[:-4] + ".transactions.idx", new_totals_spreadsheet[:-4] + ".profile.json", new_totals_spreadsheet[:-4] + ".lock", new_totals_spreadsheet[:-4] + ".periods.json"}
+    watcher = FolderWatcher(folder, outputs, arguments.watch) if arguments.watch is not None else None
+    statements = [statement for statement in get_statements(folder, new_totals_spreadsheet, answers_for) if statement not in outputs]
+    if watcher is not None:
+        # statements that arrive while these are being read are picked up by the watcher
+        watcher.snapshot = {statement: signature for statement, signature in watcher.snapshot.items() if statement in statements}
+
+    def triage(statement, prefetched=None, answers=None, ask=None):
+        if answers is None:
+            answers = answers_for(statement)
+        person = whose_statement(statement, answers, journal)
+        bank = prefetched.bank if prefetched is not None else which_bank(statement, folder, answers, journal)
+        bank_format = BANK_FORMATS[bank]
+        owed_from_statement, names = triage_transactions(
+            statement, bank_format["outgoings"], folder, person, new_totals_spreadsheet, ledger=ledger, rules=rules, history=history, group=arguments.group,
+            answers=answers, seen=seen, database=database, bank_format=bank_format, prefetched=prefetched, journal=journal, periods=periods, ask=ask
+        )
+        if manifest is not None:
+            manifest.record(statement, person, bank, owed_from_statement, names)
+        if shared is not None:
+            shared.record(statement, person, bank, owed_from_statement, names)
+
+    if arguments.batch:
+        triage_statements_in_parallel(statements, folder, ledger, rules, arguments.workers, answers_index, manifest, database, periods)
+    else:
+        # a statement from before --periods was used is read again, to find the days of its transactions
+        cached = {statement: manifest.cached(statement) if manifest is not None and (periods is None or statement in periods.statements) else None for statement in statements}
+        if arguments.prefetch:
+            read_ahead = iter_prefetched(statements, lambda statement: None if cached[statement] is not None else PrefetchedStatement.load(statement, folder, rules, answers_index))
+        else:
+            read_ahead = ((statement, None) for statement in statements)
+        for statement, prefetched in read_ahead:
+            if cached[statement] is not None:
+                ledger.apply(cached[statement]["owner"], cached[statement]["names"], cached[statement]["owes"])
+                continue
+            if shared is not None and not shared.claim(statement):
+                print(f"Skipping {statement}, it has already been split in a session.")
+                continue
+            triage(statement, prefetched)
+    if database is not None:
+        ledger = database.to_ledger(folder, new_totals_spreadsheet)
+        ledger.writer = writer
+        database.close()
+    if periods is not None:
+        periods.keep(statements)
+    if shared is not None:
+        ledger = shared.merge()
+    else:
+        ledger.flush()
+    if writer is not None:
+        writer.close()
+        ledger.writer = None
+    save_and_report(folder, new_totals_spreadsheet, ledger, manifest, seen, history, arguments.rich_report, periods, arguments.periods)
+
+    def ingest(statement):
+        if peek_statement(folder + statement)[0] is None and not bank_can_be_asked_for(folder, statement, answers_for):
+            return False
+        recorded = manifest.statements.get(statement)
+        if recorded is not None:
+            if manifest.fingerprint(statement)["sha256"] == recorded["sha256"]:
+                return False
+            # take off what the statement added before it changed
+            ledger.apply(recorded["owner"], [], {person: -owed for person, owed in recorded["owes"].items() if person != "owes"})
+        triage(statement)
+        return True
+
+    def update():
+        ledger.flush()
+        save_and_report(folder, new_totals_spreadsheet, ledger, manifest, seen, history, arguments.rich_report, periods, arguments.periods)
+
+    if watcher is not None:
+        watch_statements(watcher, ingest, update)
+    if arguments.serve is not None:
+        serve(CalculatorService(folder, new_totals_spreadsheet, ledger, rules, journal, triage, update), arguments.serve)
+    if journal is not None:
+        journal.close()
+    if PROFILE is not None:
+        PROFILE.save(folder + new_totals_spreadsheet[:-4] + ".profile.json")
+        print(f'The profile of this run is in {folder}{new_totals_spreadsheet[:-4]}.profile.json')
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main(sys.argv[1:])
\ No newline at end of file
@@ -1,3 +1,5 @@
+import json
+import shutil
 from fixtures import *
 from jointSpendingCalculator import *
 
@@ -9,10 +11,8 @@ def test_2_other_people_split_first_file_statement_owner_pays_for_second(monkeyp
     mocked_input = iter([
         'test_data', 'totals', 
         'Jan',
-        'Co-operative',
         'Padme Reggie', 'Padme Reggie', 'Padme Reggie',
         'Reggie',
-        'Monzo',
         'Reggie', 'Reggie', 'Reggie'
         ])
     monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
@@ -46,10 +46,8 @@ def test_SO_and_4_friends_split_first_transaction_and_a_few_pay_for_last_stateme
     mocked_input = iter([
         'test_data', 'totals', 
         'Jan',
-        'Co-operative',
         'Jan Padme Reggie Sophie Lou', 'Jan Lou Sophie Padme Reggie', 'Padme Sophie Lou Jan Reggie',
         'Reggie',
-        'Monzo',
         'Albert John', 'Thomas Reggie', 'Reggie Padme'
         ])
     monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
@@ -92,10 +90,8 @@ def test_2_statements_from_the_same_person(monkeypatch, directory, totals_spread
     mocked_input = iter([
         'test_data', 'totals', 
         'Jan',
-        'Co-operative',
         'Jan Padme Reggie Sophie Lou', 'Jan Lou Sophie Padme Reggie', 'Padme Sophie Lou Jan Reggie',
         'Jan',
-        'Monzo',
         'Albert John', 'Thomas Reggie', 'Reggie Padme'
         ])
     monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
@@ -126,10 +122,8 @@ def test_skip_one_transaction(monkeypatch, directory, totals_spreadsheet, delete
     mocked_input = iter([
         'test_data', 'totals', 
         'Jan',
-        'Co-operative',
         'Jan Padme Reggie Sophie Lou', '*SKIP*', 'Padme Sophie Lou Jan Reggie',
         'Jan',
-        'Monzo',
         'Albert John', '*SKIP*', 'Reggie Padme'
         ])
     monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
@@ -150,4 +144,357 @@ def test_skip_one_transaction(monkeypatch, directory, totals_spreadsheet, delete
     with open(directory + totals_spreadsheet, 'r') as t:
         t_s = csv.DictReader(t)
         totals_sheet = list(t_s)
-        assert totals_sheet == expected
\ No newline at end of file
+        assert totals_sheet == expected
+
+def test_batch_mode_writes_the_same_totals_as_a_sequential_run(monkeypatch, directory, totals_spreadsheet, delete_html_file, tmp_path):
+    '''
+    Every transaction is assigned by a rule, so statements can be split in a process pool
+    '''
+    rules_file = tmp_path / 'rules.csv'
+    rules_file.write_text(
+        'description,type,amount,payers\n'
+        'hat,,,Jan Padme\n'
+        'train,,,Padme Reggie Sophie\n'
+        'music,,,*SKIP*\n'
+        'sprouts,,,Reggie Jan\n'
+        'pizza,,,Jan\n'
+        'shoes,,,Reggie Sophie Lou\n'
+    )
+    answers = ['test_data', 'totals', 'Jan', 'Reggie']
+
+    mocked_input = iter(answers)
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main(['--rules', str(rules_file)])
+    with open(directory + totals_spreadsheet, 'r') as t:
+        sequential_totals = t.read()
+    os.remove(directory + 'totals.html')
+
+    mocked_input = iter(answers)
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main(['--rules', str(rules_file), '--batch', '--workers', '2'])
+    with open(directory + totals_spreadsheet, 'r') as t:
+        batch_totals = t.read()
+
+    assert batch_totals == sequential_totals
+    with open(directory + totals_spreadsheet, 'r') as t:
+        assert list(csv.DictReader(t)) == [
+            {'owes': 'Jan', 'Jan': '0.0', 'Padme': '126.67', 'Reggie': '116.67', 'Sophie': '116.66', 'Lou': '0.0'},
+            {'owes': 'Reggie', 'Jan': '27.5', 'Padme': '0.0', 'Reggie': '0.0', 'Sophie': '18.33', 'Lou': '18.33'}
+        ]
+
+
+answers = [
+    ('coop_statement.csv', 'owner', 'Jan'),
+    ('coop_statement.csv', 'bank', 'Co-operative'),
+    ('coop_statement.csv', 2, 'Jan Padme Reggie Sophie Lou'),
+    ('coop_statement.csv', 3, '*SKIP*'),
+    ('coop_statement.csv', 4, 'Padme Sophie Lou Jan Reggie'),
+    ('monzo_statement.csv', 'owner', 'Jan'),
+    ('monzo_statement.csv', 'bank', 'Monzo'),
+    ('monzo_statement.csv', 2, 'Albert John'),
+    ('monzo_statement.csv', 3, '*SKIP*'),
+    ('monzo_statement.csv', 4, 'Reggie Padme')
+]
+
+def write_answers_as_csv(path):
+    with open(path, 'w') as a:
+        writer = csv.writer(a)
+        writer.writerow(['statement', 'row', 'answer'])
+        writer.writerows(answers)
+
+def write_answers_as_jsonl(path):
+    with open(path, 'w') as a:
+        for statement, row, answer in answers:
+            a.write(json.dumps({'statement': statement, 'row': row, 'answer': answer}) + '\n')
+
+@pytest.mark.parametrize('answers_file,write_answers', [('answers.csv', write_answers_as_csv), ('answers.jsonl', write_answers_as_jsonl)])
+@pytest.mark.parametrize('extra_arguments', [[], ['--batch', '--workers', '2']])
+def test_replay_answers_file(monkeypatch, directory, totals_spreadsheet, delete_html_file, tmp_path, answers_file, write_answers, extra_arguments):
+    '''
+    Only the folder and the name of the totals spreadsheet are asked for, everything else comes from the answers file
+    '''
+    write_answers(str(tmp_path / answers_file))
+    mocked_input = iter(['test_data', 'totals'])
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    expected = [
+        {
+        'Albert':'7.5',
+        'Jan': '0.0',
+        'John':'7.5',
+        'Lou':'12.0',
+        'Padme': '39.5', 
+        'Sophie':'12.0',
+        'Reggie': '39.5', 
+        'owes': 'Jan'
+        }
+    ]
+    main(['--answers', str(tmp_path / answers_file)] + extra_arguments)
+
+    with open(directory + totals_spreadsheet, 'r') as t:
+        t_s = csv.DictReader(t)
+        totals_sheet = list(t_s)
+        assert totals_sheet == expected
+
+
+def test_incremental_run_only_asks_about_new_statements(monkeypatch, tmp_path, statements_folder):
+    '''
+    The second run reuses what both statements added last time, the third only asks about the statement added since
+    '''
+    write_answers_as_csv(str(tmp_path / 'answers.csv'))
+
+    mocked_input = iter([str(statements_folder), 'totals'])
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main(['--incremental', '--answers', str(tmp_path / 'answers.csv')])
+    first_totals = (statements_folder / 'totals.csv').read_text()
+
+    mocked_input = iter([str(statements_folder), 'totals'])
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main(['--incremental'])
+    assert (statements_folder / 'totals.csv').read_text() == first_totals
+
+    shutil.copy('test_data/coop_statement.csv', statements_folder / 'new_coop_statement.csv')
+    mocked_input = iter([str(statements_folder), 'totals', 'Reggie', 'Jan', '*SKIP*', 'Jan'])
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main(['--incremental'])
+    with open(statements_folder / 'totals.csv', 'r') as t:
+        assert list(csv.DictReader(t)) == [
+            {'owes': 'Jan', 'Jan': '0.0', 'Padme': '39.5', 'Reggie': '39.5', 'Sophie': '12.0', 'Lou': '12.0', 'Albert': '7.5', 'John': '7.5'},
+            {'owes': 'Reggie', 'Jan': '60.0', 'Padme': '0.0', 'Reggie': '0.0', 'Sophie': '0.0', 'Lou': '0.0', 'Albert': '0.0', 'John': '0.0'}
+        ]
+    with open(statements_folder / 'totals.manifest.json', 'r') as m:
+        assert sorted(json.load(m)['statements']) == ['coop_statement.csv', 'monzo_statement.csv', 'new_coop_statement.csv']
+
+
+def test_totals_from_the_database_match_a_normal_run(monkeypatch, tmp_path, statements_folder):
+    '''
+    The totals spreadsheet is worked out from the transactions and assignments saved in SQLite
+    '''
+    write_answers_as_csv(str(tmp_path / 'answers.csv'))
+
+    mocked_input = iter([str(statements_folder), 'totals'])
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main(['--answers', str(tmp_path / 'answers.csv')])
+    totals_without_database = (statements_folder / 'totals.csv').read_text()
+
+    mocked_input = iter([str(statements_folder), 'totals'])
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main(['--answers', str(tmp_path / 'answers.csv'), '--database', str(tmp_path / 'ledger.sqlite')])
+    assert (statements_folder / 'totals.csv').read_text() == totals_without_database
+
+    database = LedgerDatabase(str(tmp_path / 'ledger.sqlite'))
+    assert database.owed_by('Padme', '2022-12-01', '2022-12-31') == {'Jan': 3950}
+    assert database.owed_by('Padme', '2022-12-24', '2022-12-31') == {'Jan': 3550}
+    assert database.connection.execute('SELECT COUNT(*) FROM transactions').fetchone() == (4,)
+    database.close()
+
+
+def test_database_is_refused_with_incremental_runs(monkeypatch, tmp_path, statements_folder):
+    '''
+    Unchanged statements aren't read into the database on an incremental run, so the totals worked out from it would leave them out
+    '''
+    write_answers_as_csv(str(tmp_path / 'answers.csv'))
+
+    mocked_input = iter([str(statements_folder), 'totals'])
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main(['--incremental', '--answers', str(tmp_path / 'answers.csv')])
+    totals = (statements_folder / 'totals.csv').read_text()
+
+    for extra_arguments in [['--incremental'], ['--watch']]:
+        with pytest.raises(SystemExit):
+            main(extra_arguments + ['--database', str(tmp_path / 'ledger.sqlite')])
+    assert (statements_folder / 'totals.csv').read_text() == totals
+    assert not (tmp_path / 'ledger.sqlite').exists()
+
+
+def test_profile_reports_each_stage(monkeypatch, statements_folder):
+    '''
+    --profile saves the time and counters of each stage next to the totals, and the report isn't read as a statement next time
+    '''
+
+    for _ in range(2):
+        mocked_input = iter([str(statements_folder), 'totals', 'Jan', 'Padme Reggie', '*SKIP*', 'Padme Reggie', 'Reggie', 'Reggie', 'Reggie', 'Reggie'])
+        monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+        main(['--profile'])
+
+    report = json.loads((statements_folder / 'totals.profile.json').read_text())
+    assert report['peak_memory_in_mb'] > 0
+    assert report['stages']['get_statements']['calls'] == 1
+    assert report['stages']['read_statement']['calls'] == 2
+    assert report['stages']['read_statement']['rows_skipped'] == 1
+    assert report['stages']['read_statement']['rows_parsed'] == report['stages']['read_statement']['rows_not_chargeable'] + 6
+    assert report['stages']['read_statement']['bytes_read'] == sum(os.path.getsize(statements_folder / statement) for statement in ['coop_statement.csv', 'monzo_statement.csv'])
+    assert report['stages']['ask_who_should_pay']['calls'] == 6
+    assert report['stages']['write_to_totals_spreadsheet']['bytes_written'] == os.path.getsize(statements_folder / 'totals.csv')
+    assert report['stages']['create_table_in_html_file']['bytes_written'] == os.path.getsize(statements_folder / 'totals.html')
+
+
+def test_prefetch_writes_the_same_totals_as_a_normal_run(monkeypatch, statements_folder):
+    '''
+    Reading the next statement in the background and saving the totals on another thread doesn't change them
+    '''
+    answers = ['Jan', 'Padme Reggie', '*SKIP*', 'Padme Reggie', 'Reggie', 'Jan', 'Reggie Sophie', 'Reggie']
+
+    mocked_input = iter([str(statements_folder), 'totals'] + answers)
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main([])
+    totals = (statements_folder / 'totals.csv').read_text()
+
+    mocked_input = iter([str(statements_folder), 'totals'] + answers)
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main(['--prefetch'])
+    assert (statements_folder / 'totals.csv').read_text() == totals
+    with open(statements_folder / 'totals.csv', 'r') as t:
+        assert list(csv.DictReader(t)) == [
+            {'owes': 'Jan', 'Jan': '0.0', 'Padme': '30.0', 'Reggie': '30.0', 'Sophie': '0.0'},
+            {'owes': 'Reggie', 'Jan': '15.0', 'Padme': '0.0', 'Reggie': '0.0', 'Sophie': '10.0'}
+        ]
+
+
+def test_resume_only_asks_what_the_journal_has_not_answered(monkeypatch, tmp_path, statements_folder):
+    '''
+    The first run stops part way through the second statement, resuming from its journal asks only about the rest
+    '''
+    journal = str(tmp_path / 'journal.jsonl')
+
+    mocked_input = iter([str(statements_folder), 'totals', 'Jan', 'Padme Reggie', '*SKIP*', 'Padme Reggie', 'Reggie', 'Jan'])
+    def input_until_the_run_stops(_):
+        answer = next(mocked_input, None)
+        if answer is None:
+            raise KeyboardInterrupt
+        return answer
+    monkeypatch.setattr('builtins.input', input_until_the_run_stops)
+    with pytest.raises(KeyboardInterrupt):
+        main(['--journal', journal])
+    with pytest.raises(SystemExit):
+        main(['--journal', journal])
+
+    mocked_input = iter([str(statements_folder), 'totals', 'Reggie Sophie', 'Reggie'])
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main(['--journal', journal, '--resume'])
+    with open(statements_folder / 'totals.csv', 'r') as t:
+        assert list(csv.DictReader(t)) == [
+            {'owes': 'Jan', 'Jan': '0.0', 'Padme': '30.0', 'Reggie': '30.0', 'Sophie': '0.0'},
+            {'owes': 'Reggie', 'Jan': '15.0', 'Padme': '0.0', 'Reggie': '0.0', 'Sophie': '10.0'}
+        ]
+    assert [(answer['statement'], answer['row']) for answer in iter_answers(journal)][-3:] == [('monzo_statement.csv', '2'), ('monzo_statement.csv', '3'), ('monzo_statement.csv', '4')]
+
+
+def test_watch_adds_new_statements_and_replaces_changed_ones(monkeypatch, statements_folder):
+    '''
+    A statement dropped in the folder is asked about and added, and one that changes replaces what it added before
+    '''
+    (statements_folder / 'monzo_statement.csv').unlink()
+
+    def drop_in_statements():
+        yield lambda: shutil.copy('test_data/monzo_statement.csv', statements_folder / 'monzo_statement.csv')
+        yield lambda: None
+        yield lambda: (statements_folder / 'coop_statement.csv').write_text((statements_folder / 'coop_statement.csv').read_text().replace('\n2022-12-28,Music,PURCHASE,,40,10', ''))
+        yield lambda: None
+    actions = drop_in_statements()
+    def wait(watcher):
+        action = next(actions, None)
+        if action is None:
+            raise KeyboardInterrupt
+        action()
+    monkeypatch.setattr(FolderWatcher, 'wait', wait)
+
+    mocked_input = iter([str(statements_folder), 'totals', 'Jan', 'Padme Reggie', '*SKIP*', 'Padme Reggie', 'Reggie', 'Jan', 'Reggie Sophie', 'Reggie', 'Jan', 'Padme', '*SKIP*'])
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main(['--watch'])
+    assert next(mocked_input, None) is None
+    with open(statements_folder / 'totals.csv', 'r') as t:
+        assert list(csv.DictReader(t)) == [
+            {'owes': 'Jan', 'Jan': '0.0', 'Padme': '20.0', 'Reggie': '0.0', 'Sophie': '0.0'},
+            {'owes': 'Reggie', 'Jan': '15.0', 'Padme': '0.0', 'Reggie': '0.0', 'Sophie': '10.0'}
+        ]
+    assert '<td>20.0</td>' in (statements_folder / 'totals.html').read_text()
+
+
+def test_sessions_add_to_the_same_totals(monkeypatch, statements_folder):
+    '''
+    A second session skips the statement the first one split, and the totals have both sessions in them
+    '''
+    SharedTotals(f'{statements_folder}/', 'totals.csv', 'reggie').claim('monzo_statement.csv')
+
+    mocked_input = iter([str(statements_folder), 'totals', 'Jan', 'Padme Reggie', '*SKIP*', 'Padme Reggie'])
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main(['--session', 'jan'])
+
+    mocked_input = iter([str(statements_folder), 'totals', 'Reggie', 'Jan', 'Reggie Sophie', 'Reggie'])
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main(['--session', 'reggie'])
+    with open(statements_folder / 'totals.csv', 'r') as t:
+        assert list(csv.DictReader(t)) == [
+            {'owes': 'Jan', 'Jan': '0.0', 'Padme': '30.0', 'Reggie': '30.0', 'Sophie': '0.0'},
+            {'owes': 'Reggie', 'Jan': '15.0', 'Padme': '0.0', 'Reggie': '0.0', 'Sophie': '10.0'}
+        ]
+
+
+def test_periods_add_a_table_for_each_month(monkeypatch, tmp_path, statements_folder):
+    '''
+    The HTML has a table for each month worked out from the index of days, and the months add up to the totals
+    '''
+    (statements_folder / 'monzo_statement.csv').write_text(open('test_data/monzo_statement.csv').read().replace('2022-12-28', '2023-01-03'))
+    write_answers_as_csv(str(tmp_path / 'answers.csv'))
+
+    mocked_input = iter([str(statements_folder), 'totals'])
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main(['--answers', str(tmp_path / 'answers.csv'), '--periods', 'month'])
+
+    html = (statements_folder / 'totals.html').read_text()
+    assert '<h2>2022-12</h2>' in html and '<h2>2023-01</h2>' in html
+    index = PeriodIndex.load(str(statements_folder / 'totals.periods.json'))
+    assert index.owed_between('2023-01-01', '2023-01-31')[1] == [{'owes': 'Jan', 'Albert': 0.0, 'John': 0.0, 'Padme': 27.5, 'Sophie': 0.0, 'Lou': 0.0, 'Reggie': 27.5}]
+    december = index.owed_between('2022-12-01', '2022-12-31')[1][0]
+    with open(statements_folder / 'totals.csv', 'r') as t:
+        totals = next(csv.DictReader(t))
+    assert {person: float(totals[person]) for person in december if person != 'owes'} == {person: round(december[person] + (27.5 if person in ('Padme', 'Reggie') else 0), 2) for person in december if person != 'owes'}
+
+
+def test_statements_uploaded_to_the_server_are_kept_like_any_other(monkeypatch, tmp_path, statements_folder):
+    '''
+    A statement uploaded and answered over HTTP is in the manifest, so the next incremental run doesn't ask about it,
+    and its transactions are in the dedupe index, so a copy of it adds nothing
+    '''
+    (statements_folder / 'monzo_statement.csv').unlink()
+    write_answers_as_csv(str(tmp_path / 'answers.csv'))
+
+    def upload_and_answer(service, port):
+        for statement in ['monzo_statement.csv', 'monzo_copy.csv']:
+            service.upload(statement, 'Reggie', open('test_data/monzo_statement.csv', 'rb').read())
+            assert service.answer(statement, {'2': 'Jan', '3': 'Reggie Sophie', '4': 'Reggie'})['applied']
+    monkeypatch.setattr('jointSpendingCalculator.serve', upload_and_answer)
+    mocked_input = iter([str(statements_folder), 'totals'])
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main(['--serve', '0', '--incremental', '--dedupe', '--answers', str(tmp_path / 'answers.csv')])
+    served_totals = (statements_folder / 'totals.csv').read_text()
+    with open(statements_folder / 'totals.csv', 'r') as t:
+        assert list(csv.DictReader(t)) == [
+            {'owes': 'Jan', 'Jan': '0.0', 'Padme': '12.0', 'Reggie': '12.0', 'Sophie': '12.0', 'Lou': '12.0'},
+            {'owes': 'Reggie', 'Jan': '15.0', 'Padme': '0.0', 'Reggie': '0.0', 'Sophie': '10.0', 'Lou': '0.0'}
+        ]
+    with open(statements_folder / 'totals.manifest.json', 'r') as m:
+        assert sorted(json.load(m)['statements']) == ['coop_statement.csv', 'monzo_copy.csv', 'monzo_statement.csv']
+
+    mocked_input = iter([str(statements_folder), 'totals'])
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main(['--incremental', '--dedupe'])
+    assert (statements_folder / 'totals.csv').read_text() == served_totals
+
+
+def test_statement_with_an_extra_column_asks_which_bank_it_is_from(monkeypatch, statements_folder):
+    '''
+    A Monzo export with an extra column isn't a header that's known, so which bank it is from is asked for, then it is read as normal
+    '''
+    monzo = open('test_data/monzo_statement.csv').read().splitlines()
+    (statements_folder / 'monzo_statement.csv').write_text('\n'.join(line + ',Notes' for line in monzo) + '\n')
+
+    mocked_input = iter([str(statements_folder), 'totals', 'Jan', 'Padme Reggie', '*SKIP*', 'Padme Reggie', 'Reggie', 'Monzo', 'Jan', 'Reggie Sophie', 'Reggie'])
+    monkeypatch.setattr('builtins.input', lambda _:next(mocked_input))
+    main([])
+    assert next(mocked_input, None) is None
+    with open(statements_folder / 'totals.csv', 'r') as t:
+        assert list(csv.DictReader(t)) == [
+            {'owes': 'Jan', 'Jan': '0.0', 'Padme': '30.0', 'Reggie': '30.0', 'Sophie': '0.0'},
+            {'owes': 'Reggie', 'Jan': '15.0', 'Padme': '0.0', 'Reggie': '0.0', 'Sophie': '10.0'}
+        ]
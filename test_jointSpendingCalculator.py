@@ -4,6 +4,19 @@ from unittest.mock import patch
 from jointSpendingCalculator import *
 import os
 import csv
+import pandas
+import subprocess
+import sys
+import jointSpendingCalculator
+import json
+import threading
+import time
+import concurrent.futures
+import gzip
+import zipfile
+import hashlib
+import urllib.request
+import urllib.error
 
 
 class TestGetDetails:
@@ -89,8 +102,8 @@ class TestReadStatement:
             "Jan", 
             {
                 "owes":"Padme",
-                "Jan":90.0,
-                "Padme":0.0
+                "Jan":9000,
+                "Padme":0
             }
         ),
 
@@ -102,9 +115,9 @@ class TestReadStatement:
             "Jan Sophie", 
             {
                 "owes": "Reggie",
-                "Jan": 45.0,
-                "Sophie": 45.0,
-                "Reggie": 0.0                
+                "Jan": 4500,
+                "Sophie": 4500,
+                "Reggie": 0                
             }
         ),
 
@@ -116,13 +129,14 @@ class TestReadStatement:
             "Sophie Jane Sven",
             {
                 "owes": "Jan",
-                "Sophie": 30.0,
-                "Jane": 30.0,
-                "Sven": 30.0,
-                "Jan": 0.0
+                "Sophie": 3000,
+                "Jane": 3000,
+                "Sven": 3000,
+                "Jan": 0
             }
         ),
-        # Read Sophie's statement - Sophie and Lou split everything between them
+        # Read Sophie's statement - Sophie, Lou and Nai split everything between them
+        # the pennies that don't split evenly are shared out across the statement, so it adds up exactly
         (
             "Sophie",
             "coop_statement.csv",
@@ -130,9 +144,9 @@ class TestReadStatement:
             "Sophie Lou Nai",
             {
                 "owes": "Sophie",
-                "Sophie": 0.0,
-                "Lou": 136.67,
-                "Nai": 136.67
+                "Sophie": 0,
+                "Lou": 13667,
+                "Nai": 13666
             }
         ),
         (
@@ -142,7 +156,7 @@ class TestReadStatement:
             "*SKIP*",
             {
                 "owes": "Sophie",
-                "Sophie": 0.0
+                "Sophie": 0
             }
         )
     ]
@@ -157,6 +171,803 @@ class TestReadStatement:
         assert people.sort() == everyone_who_owes_from_this_statement.sort()
 
 
+class TestParseOutgoings:
+    test_cases = [
+        (["20", "350.00", "40"], [2000, 35000, 4000], [True, True, True]),
+        (["", None, "   "], [0, 0, 0], [False, False, False]),
+        (["-15.50", "+2", "(12.00)"], [1550, 200, 1200], [True, True, True]),
+        (["£1,250.00", " $3.10 ", "€.5"], [125000, 310, 50], [True, True, True]),
+        (["0.00", "abc", "12.3.4"], [0, 0, 0], [False, False, False])
+    ]
+
+    @pytest.mark.parametrize("values,expected_costs,expected_chargeable", test_cases)
+    def test_parse_outgoings(self, values, expected_costs, expected_chargeable):
+        costs, chargeable = parse_outgoings(values)
+        assert costs.tolist() == expected_costs
+        assert chargeable.tolist() == expected_chargeable
+
+    test_cases_sign = [
+        ("absolute", [True, True, True, True]),
+        ("negative", [True, False, True, False]),
+        ("positive", [False, True, False, True])
+    ]
+
+    @pytest.mark.parametrize("sign,expected_chargeable", test_cases_sign)
+    def test_only_outgoings_with_the_banks_sign_are_chargeable(self, sign, expected_chargeable):
+        costs, chargeable = parse_outgoings(["-15.50", "20", "(12.00)", "+2"], sign)
+        assert costs.tolist() == [1550, 2000, 1200, 200]
+        assert chargeable.tolist() == expected_chargeable
+
+
+class TestStreamingStatement:
+    '''A synthetic statement is streamed through the pipeline in a separate process so its peak memory can be measured'''
+    script = '''
+import csv, resource, sys
+from jointSpendingCalculator import *
+
+def synthetic_statement(rows):
+    yield "Date,Description,Type,Money In, Money Out, Balance\\n"
+    for row in range(rows):
+        yield f"2022-12-{row % 28 + 1:02d},Shop {row % 100},PURCHASE,,{row % 50 + 1}.25,10\\n"
+
+transactions = iter_chargeable_transactions(csv.DictReader(synthetic_statement(int(sys.argv[1]))), " Money Out")
+owes, names = aggregate_owes(iter_assignments(transactions, lambda transaction, cost: ["Jan", "Sophie"]), "Jan")
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024, owes["Sophie"], len(names))
+'''
+    rss_ceiling_in_mb = 200
+
+    def test_5_million_row_statement_stays_under_memory_ceiling(self):
+        result = subprocess.run([sys.executable, "-c", self.script, "5000000"], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        peak_rss_in_mb, owed_by_sophie, number_of_names = result.stdout.split()
+        assert int(peak_rss_in_mb) < self.rss_ceiling_in_mb
+        assert int(owed_by_sophie) == 6437500000
+        assert number_of_names == "2"
+
+
+class TestAssignmentRules:
+    rules = [
+        {"description": "sprouts", "type": "", "amount": "", "payers": "Jan Sophie"},
+        {"description": "", "type": "BP/SO", "amount": "350", "payers": "*SKIP*"},
+        {"description": "padme*fuel", "type": "", "amount": "", "payers": "Padme"},
+        {"description": "", "type": "bp/so", "amount": "", "payers": "Reggie"}
+    ]
+    test_cases = [
+        ({"Description": "Reggie Sprouts", "Type": "PURCHASE"}, 1500, "Jan Sophie"),
+        ({"Description": "Train tickets", "Type": "BP/SO"}, 35000, "*SKIP*"),
+        ({"Description": "Padme          Fuel", "Type": "CREDIT"}, 500, "Padme"),
+        ({"Description": "A hat", "Type": "BP/SO"}, 2000, "Reggie"),
+        ({"Description": "Music", "Type": "PURCHASE"}, 4000, None)
+    ]
+
+    @pytest.mark.parametrize("transaction,cost,expected", test_cases)
+    def test_first_matching_rule_wins(self, transaction, cost, expected):
+        rules = AssignmentRules(self.rules)
+        assert rules.match(transaction, cost) == expected
+
+    def test_read_statement_only_asks_about_unmatched_transactions(self, directory, rules_file):
+        rules = AssignmentRules.from_file(rules_file)
+        with patch("builtins.input", side_effect=["Jan Sophie"]):
+            owed_from_statement, names = read_statement("coop_statement.csv", " Money Out", "Jan", directory, rules)
+        assert owed_from_statement == {"owes": "Jan", "Jan": 0, "Sophie": 18500, "Lou": 17500}
+        assert names == ["Jan", "Sophie", "Lou"]
+
+
+class TestAssignmentHistory:
+    test_cases_normalise = [
+        ("Padme          Fuel", "padme fuel"),
+        ("TESCO STORES 3456 LONDON", "tesco stores london"),
+        ("Amazon.co.uk*AB12CD", "amazon co uk ab cd"),
+        (None, "")
+    ]
+
+    @pytest.mark.parametrize("description,expected", test_cases_normalise)
+    def test_normalise_description(self, description, expected):
+        assert normalise_description(description) == expected
+
+    test_cases_suggest = [
+        ("Reggie Sprouts", "Jan Sophie"),
+        ("REGGIE SPROUTS 0423", "Jan Sophie"),
+        ("Tesco Stores London", "Jan"),
+        ("Tesko Stores", "Jan"),
+        ("Train tickets", None)
+    ]
+
+    @pytest.mark.parametrize("description,expected", test_cases_suggest)
+    def test_suggest(self, tmp_path, description, expected):
+        history = AssignmentHistory(str(tmp_path / "history.csv"))
+        history.remember("Reggie Sprouts", "Jan Sophie")
+        history.remember("Tesco Stores", "Jan")
+        assert history.suggest(description) == expected
+
+    def test_unrelated_description_with_the_same_first_word_does_not_hide_a_similar_one(self, tmp_path):
+        history = AssignmentHistory(str(tmp_path / "history.csv"))
+        history.remember("AMAZON MARKETPLACE", "Bob")
+        history.remember("CARD PAYMENT", "Jan")
+        assert history.suggest("card amazon marketplace") == "Bob"
+
+    def test_remembering_replaces_cached_suggestions(self, tmp_path):
+        history = AssignmentHistory(str(tmp_path / "history.csv"))
+        assert history.suggest("Nice shoes") is None
+        history.remember("Nice shoes", "Padme")
+        assert history.suggest("Nice shoes") == "Padme"
+
+    def test_answers_are_saved_and_offered_as_the_default(self, directory, tmp_path):
+        path = str(tmp_path / "history.csv")
+        history = AssignmentHistory(path)
+        history.remember("Reggie Sprouts", "Jan Sophie")
+        with patch("builtins.input", side_effect=["", "Jan", "Jan"]) as mocked_input:
+            owed_from_statement, _ = read_statement("monzo_statement.csv", "Amount", "Padme", directory, history=history)
+        assert mocked_input.call_args_list[0].args[0].endswith("[Jan Sophie]: ")
+        assert owed_from_statement == {"owes": "Padme", "Padme": 0, "Jan": 8250, "Sophie": 750}
+
+        history.save()
+        reloaded = AssignmentHistory(path)
+        assert reloaded.answers == {"reggie sprouts": "Jan Sophie", "jan pizza": "Jan", "nice shoes": "Jan"}
+
+
+class TestGroupedStatement:
+    statement = (
+        "Date,Description,Type,Money In,Amount, Balance\n"
+        "2022-12-22,Reggie Sprouts,PURCHASE,,15,105\n"
+        "2022-12-23,Jan Pizza,PURCHASE,,20,85\n"
+        "2022-12-24,REGGIE  SPROUTS,PURCHASE,,15,65\n"
+        "2022-12-25,Train tickets,BP/SO,,350,50\n"
+        "2022-12-28,Reggie Sprouts,PURCHASE,,10,40\n"
+    )
+
+    def test_one_prompt_per_description(self, tmp_path):
+        (tmp_path / "statement.csv").write_text(self.statement)
+        with patch("builtins.input", side_effect=["Jan Sophie", "Jan", "*SKIP*"]) as mocked_input:
+            with patch("builtins.print") as mocked_print:
+                owed_from_statement, names = read_statement("statement.csv", "Amount", "Padme", f"{tmp_path}/", group=True)
+        assert mocked_input.call_count == 3
+        assert "'Transactions': 3, 'Total': '40.00'" in str(mocked_print.call_args_list[2])
+        assert owed_from_statement == {"owes": "Padme", "Padme": 0, "Jan": 4000, "Sophie": 2000}
+        assert names == ["Padme", "Jan", "Sophie"]
+
+    def test_rules_still_apply_to_single_transactions(self, tmp_path):
+        (tmp_path / "statement.csv").write_text(self.statement)
+        rules = AssignmentRules([{"description": "sprouts", "type": "", "amount": "10", "payers": "Reggie"}])
+        with patch("builtins.input", side_effect=["Jan Sophie", "Jan", "*SKIP*"]):
+            owed_from_statement, _ = read_statement("statement.csv", "Amount", "Padme", f"{tmp_path}/", rules=rules, group=True)
+        assert owed_from_statement == {"owes": "Padme", "Padme": 0, "Reggie": 1000, "Jan": 3500, "Sophie": 1500}
+
+
+class TestStatementAnswers:
+
+    def test_answers_are_found_for_their_own_statement_in_any_order(self, tmp_path):
+        path = tmp_path / "answers.csv"
+        path.write_text(
+            "statement,row,answer\n"
+            "a.csv,owner,Jan\n"
+            "b.csv,owner,Sophie\n"
+            "a.csv,3,Padme\n"
+            "a.csv,2,Jan Sophie\n"
+        )
+        answers = StatementAnswers(str(path), "a.csv")
+        assert answers.answer_for("owner") == "Jan"
+        assert answers.answer_for("bank") is None
+        assert answers.answer_for(2) == "Jan Sophie"
+        assert answers.answer_for(3) == "Padme"
+        assert answers.answer_for(4) is None
+
+    test_cases_index = [
+        ("answers.csv", "statement,row,answer\na.csv,owner,Jan\nb.csv,owner,Sophie\na.csv,3,\"Padme\nJan\"\na.csv,2,Jan Sophie\n"),
+        ("answers.jsonl", '{"statement": "a.csv", "row": "owner", "answer": "Jan"}\n{"statement": "b.csv", "row": "owner", "answer": "Sophie"}\n\n'
+                          '{"statement": "a.csv", "row": 3, "answer": "Padme\\nJan"}\n{"statement": "a.csv", "row": 2, "answer": "Jan Sophie"}\n{"statement": "b.csv", "ro')
+    ]
+
+    @pytest.mark.parametrize("name,text", test_cases_index)
+    def test_index_reads_only_the_answers_for_each_statement(self, tmp_path, name, text):
+        path = tmp_path / name
+        path.write_text(text)
+        index = AnswersIndex(str(path))
+        assert len(index.ranges["a.csv"]) == 2
+        assert len(index.ranges["b.csv"]) == 1
+        for statement in ["a.csv", "b.csv", "c.csv"]:
+            expected = [answer for answer in iter_answers(str(path)) if answer["statement"] == statement]
+            assert list(iter_answers(str(path), index.ranges.get(statement, []))) == expected
+        answers = index.answers_for("a.csv")
+        assert [answers.answer_for(row) for row in ["owner", 2, 3, 4]] == ["Jan", "Jan Sophie", "Padme\nJan", None]
+
+    def test_blank_answers_are_asked_about_not_skipped(self, tmp_path, directory):
+        path = tmp_path / "answers.csv"
+        path.write_text("statement,row,answer\nmonzo_statement.csv,2,\nmonzo_statement.csv,3,Jan\nmonzo_statement.csv,4,  \n")
+        answers = StatementAnswers(str(path), "monzo_statement.csv")
+        with patch("builtins.input", side_effect=["", "Sophie", "Sophie"]) as mocked_input:
+            owed_from_statement, _ = read_statement("monzo_statement.csv", "Amount", "Padme", directory, answers=answers)
+        assert mocked_input.call_count == 3
+        assert owed_from_statement == {"owes": "Padme", "Padme": 0, "Sophie": 7000, "Jan": 2000}
+        with pytest.raises(ValueError):
+            read_statement("monzo_statement.csv", "Amount", "Padme", directory, ask=refuse_to_ask, answers=StatementAnswers(str(path), "monzo_statement.csv"))
+
+    def test_unanswered_transactions_are_asked_about(self, tmp_path, directory):
+        path = tmp_path / "answers.csv"
+        path.write_text("statement,row,answer\nmonzo_statement.csv,3,Jan\n")
+        answers = StatementAnswers(str(path), "monzo_statement.csv")
+        with patch("builtins.input", side_effect=["Sophie", "Sophie"]) as mocked_input:
+            owed_from_statement, _ = read_statement("monzo_statement.csv", "Amount", "Padme", directory, answers=answers)
+        assert mocked_input.call_count == 2
+        assert owed_from_statement == {"owes": "Padme", "Padme": 0, "Sophie": 7000, "Jan": 2000}
+
+
+class TestBankFormats:
+    test_cases_detect = [
+        ("coop_statement.csv", "Co-operative"),
+        ("monzo_statement.csv", "Monzo")
+    ]
+
+    @pytest.mark.parametrize("statement,expected", test_cases_detect)
+    def test_detect_bank_from_header(self, directory, statement, expected):
+        assert detect_bank(directory + statement) == expected
+
+    def test_unknown_header_asks_which_bank(self, tmp_path):
+        (tmp_path / "statement.csv").write_text("When,What,How much\n")
+        assert detect_bank(str(tmp_path / "statement.csv")) is None
+        with patch("builtins.input", side_effect=["monzo"]) as mocked_input:
+            assert which_bank("statement.csv", f"{tmp_path}/") == "Monzo"
+        assert mocked_input.call_count == 1
+
+    def test_registered_bank_is_detected_and_read(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("jointSpendingCalculator.BANK_FORMATS", dict(BANK_FORMATS))
+        monkeypatch.setattr("jointSpendingCalculator.BANK_SIGNATURES", dict(BANK_SIGNATURES))
+        banks = tmp_path / "banks.json"
+        banks.write_text(json.dumps({
+            "Starling": {
+                "header": ["Transaction Date", "Counter Party", "Kind", "Amount (GBP)", "Balance (GBP)"],
+                "outgoings": "Amount (GBP)",
+                "sign": "negative",
+                "date_format": "%d/%m/%Y",
+                "columns": {"date": "Transaction Date", "description": "Counter Party", "type": "Kind"}
+            }
+        }))
+        load_bank_formats(str(banks))
+        (tmp_path / "statement.csv").write_text(
+            "Transaction Date,Counter Party,Kind,Amount (GBP),Balance (GBP)\n"
+            "22/12/2022,Reggie Sprouts,CARD,-15.00,85.00\n"
+            "23/12/2022,Salary,FASTER PAYMENT,1000.00,1085.00\n"
+            "24/12/2022,Jan Pizza,CARD,-20.00,1065.00\n"
+        )
+        assert which_bank("statement.csv", f"{tmp_path}/") == "Starling"
+
+        assignments = []
+        with patch("builtins.input", side_effect=["Jan Sophie", "Jan"]) as mocked_input:
+            owed_from_statement, _ = read_statement("statement.csv", "Amount (GBP)", "Padme", f"{tmp_path}/", record=assignments.append, bank_format=jointSpendingCalculator.BANK_FORMATS["Starling"])
+        assert mocked_input.call_count == 2
+        assert owed_from_statement == {"owes": "Padme", "Padme": 0, "Jan": 2750, "Sophie": 750}
+        assert [(transaction["Date"], transaction["Description"]) for _, transaction, _, _ in assignments] == [("2022-12-22", "Reggie Sprouts"), ("2022-12-24", "Jan Pizza")]
+
+
+class TestPrefetch:
+
+    def test_next_statement_is_prepared_while_the_current_one_is_used(self):
+        started = {statement: threading.Event() for statement in "abc"}
+        def prepare(statement):
+            started[statement].set()
+            return statement.upper()
+
+        read_ahead = iter_prefetched(["a", "b", "c"], prepare)
+        assert next(read_ahead) == ("a", "A")
+        assert started["b"].wait(timeout=5)
+        assert not started["c"].is_set()
+        assert list(read_ahead) == [("b", "B"), ("c", "C")]
+
+    def test_prefetched_statement_matches_reading_it_then(self, directory, rules_file):
+        rules = AssignmentRules.from_file(rules_file)
+        prefetched = PrefetchedStatement.load("coop_statement.csv", directory, rules)
+        assert prefetched.bank == "Co-operative"
+        assert [row_number for row_number, _, _ in prefetched.transactions] == [2, 3, 4]
+        assert [prefetched.match(transaction, cost) for _, transaction, cost in prefetched.transactions] == [None, "Sophie Lou", "*SKIP*"]
+
+        with patch("builtins.input", side_effect=["Jan Sophie"]) as mocked_input:
+            owed_from_statement, names = read_statement("coop_statement.csv", " Money Out", "Jan", directory, rules, prefetched=prefetched)
+        assert mocked_input.call_count == 1
+        assert owed_from_statement == {"owes": "Jan", "Jan": 0, "Sophie": 18500, "Lou": 17500}
+        assert names == ["Jan", "Sophie", "Lou"]
+
+    def test_only_the_start_of_a_statement_is_read_ahead(self, directory, rules_file):
+        rules = AssignmentRules.from_file(rules_file)
+        prefetched = PrefetchedStatement.load("coop_statement.csv", directory, rules, rows=2)
+        assert [row_number for row_number, _, _ in prefetched.transactions] == [2, 3]
+        assert [(row_number, prefetched.match(transaction, cost)) for row_number, transaction, cost in prefetched.iter_transactions()] == [(2, None), (3, "Sophie Lou"), (4, "*SKIP*")]
+
+    def test_unrecognised_statement_is_left_to_be_read_after_asking_for_the_bank(self, tmp_path):
+        (tmp_path / "statement.csv").write_text("When,What,How much\n")
+        assert PrefetchedStatement.load("statement.csv", f"{tmp_path}/") is None
+
+    def test_background_writer_writes_in_order_and_reports_errors(self, tmp_path):
+        writer = BackgroundWriter()
+        path = tmp_path / "written.txt"
+        for number in range(20):
+            writer.submit(path.write_text, str(number))
+        writer.submit(open, str(tmp_path / "missing" / "file.txt"), "r")
+        with pytest.raises(FileNotFoundError):
+            writer.close()
+        assert path.read_text() == "19"
+
+
+class TestJournal:
+
+    def test_answers_are_on_disk_as_soon_as_they_are_given(self, tmp_path):
+        path = str(tmp_path / "journal.jsonl")
+        journal = Journal(path, sync_every=3)
+        journal.append("a.csv", "owner", "Jan")
+        journal.append("a.csv", 2, "Jan Sophie")
+        assert journal._unsynced == 2
+        assert list(iter_answers(path)) == [
+            {"statement": "a.csv", "row": "owner", "answer": "Jan"},
+            {"statement": "a.csv", "row": "2", "answer": "Jan Sophie"}
+        ]
+        journal.append("a.csv", 3, "*SKIP*")
+        assert journal._unsynced == 0
+        journal.close()
+
+    test_cases_resume = [
+        (False, True, ["b.csv"]),
+        (True, False, ["a.csv", "b.csv"])
+    ]
+
+    @pytest.mark.parametrize("resume,overwrite,expected", test_cases_resume)
+    def test_journal_is_only_kept_when_resuming(self, tmp_path, resume, overwrite, expected):
+        path = str(tmp_path / "journal.jsonl")
+        journal = Journal(path)
+        journal.append("a.csv", "owner", "Jan")
+        journal.close()
+        journal = Journal(path, resume, overwrite)
+        journal.append("b.csv", "owner", "Sophie")
+        journal.close()
+        assert [answer["statement"] for answer in iter_answers(path)] == expected
+
+    def test_journal_with_answers_is_not_overwritten_unless_asked(self, tmp_path):
+        path = tmp_path / "journal.jsonl"
+        path.write_text('{"statement": "a.csv", "row": 2, "answer": "Jan"}\n')
+        with pytest.raises(FileExistsError):
+            Journal(str(path))
+        assert path.read_text() == '{"statement": "a.csv", "row": 2, "answer": "Jan"}\n'
+        path.write_text("")
+        Journal(str(path)).close()
+
+    test_cases_cut_short = [
+        '{"statement": "a.csv", "row": 2, "answer": "Jan"}\n{"statement": "a.csv", "row": 3, "ans',
+        '{"statement": "a.csv", "row": 2, "answer": "Jan"}\n',
+        '{"statement": "a.csv", "row": 2, "answer": "Jan"}\n{"statement": "a.csv", "row": 3, "answer": "' + "x" * 10000
+    ]
+
+    @pytest.mark.parametrize("written", test_cases_cut_short)
+    def test_resuming_twice_from_an_answer_cut_short(self, tmp_path, written):
+        path = tmp_path / "journal.jsonl"
+        path.write_text(written)
+        journal = Journal(str(path), resume=True)
+        journal.append("a.csv", 3, "Jan Bob")
+        journal.close()
+        journal = Journal(str(path), resume=True)
+        journal.append("a.csv", 4, "*SKIP*")
+        journal.close()
+        assert list(iter_answers(str(path))) == [
+            {"statement": "a.csv", "row": "2", "answer": "Jan"},
+            {"statement": "a.csv", "row": "3", "answer": "Jan Bob"},
+            {"statement": "a.csv", "row": "4", "answer": "*SKIP*"}
+        ]
+
+    def test_last_answer_cut_short_is_ignored(self, tmp_path):
+        path = tmp_path / "journal.jsonl"
+        path.write_text('{"statement": "a.csv", "row": 2, "answer": "Jan"}\n{"statement": "a.csv", "ro')
+        assert list(iter_answers(str(path))) == [{"statement": "a.csv", "row": "2", "answer": "Jan"}]
+
+    def test_answers_not_in_the_journal_come_from_the_fallback(self, tmp_path):
+        (tmp_path / "journal.jsonl").write_text('{"statement": "a.csv", "row": 2, "answer": "Jan"}\n')
+        (tmp_path / "answers.csv").write_text("statement,row,answer\na.csv,owner,Sophie\na.csv,2,Padme\n")
+        answers = StatementAnswers(str(tmp_path / "journal.jsonl"), "a.csv", StatementAnswers(str(tmp_path / "answers.csv"), "a.csv"))
+        assert answers.answer_for(2) == "Jan"
+        assert answers.answer_for("owner") == "Sophie"
+        assert answers.answer_for(3) is None
+
+
+class TestStatementDiscovery:
+
+    @pytest.fixture
+    def archive_folder(self, tmp_path):
+        coop = open("test_data/coop_statement.csv").read()
+        monzo = open("test_data/monzo_statement.csv").read()
+        (tmp_path / "2023" / "01").mkdir(parents=True)
+        (tmp_path / "2022" / "11").mkdir(parents=True)
+        (tmp_path / "2023" / "01" / "coop.csv").write_text(coop.replace("2022-12-", "2023-01-"))
+        with gzip.open(tmp_path / "2022" / "11" / "monzo.csv.gz", "wt") as gzipped:
+            gzipped.write(monzo.replace("2022-12-", "2022-11-"))
+        with zipfile.ZipFile(tmp_path / "2022" / "december.zip", "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("coop.csv", coop)
+            archive.writestr("notes.txt", "not a statement")
+        (tmp_path / "totals.csv").write_text("owes,Jan\nSophie,10.0\n")
+        (tmp_path / "totals.html").write_text("<table></table>")
+        (tmp_path / "unknown_bank.csv").write_text("When,What,How much\n2020-01-01,Cake,5\n")
+        (tmp_path / ".hidden").mkdir()
+        (tmp_path / ".hidden" / "coop.csv").write_text(coop)
+        return f"{tmp_path}/"
+
+    def test_statements_are_found_in_sub_directories_and_archives_oldest_first(self, archive_folder):
+        with patch("builtins.print") as mocked_print:
+            statements = get_statements(archive_folder, "totals.csv")
+        assert statements == ["2022/11/monzo.csv.gz", "2022/december.zip/coop.csv", "2023/01/coop.csv"]
+        assert "unknown_bank.csv" in str(mocked_print.call_args_list)
+
+    def test_statement_with_an_extra_column_is_kept_to_ask_which_bank(self, archive_folder):
+        monzo = open("test_data/monzo_statement.csv").read().splitlines()
+        with open(archive_folder + "2023/01/monzo_with_notes.csv", "w") as statement_file:
+            statement_file.write("\n".join(line + ",Notes" for line in monzo) + "\n")
+        with patch("builtins.print"):
+            statements = get_statements(archive_folder, "totals.csv")
+        assert "2023/01/monzo_with_notes.csv" in statements
+        assert detect_bank(archive_folder + "2023/01/monzo_with_notes.csv") is None
+
+    test_cases_compressed = [
+        ("2022/december.zip/coop.csv", "Co-operative"),
+        ("2022/11/monzo.csv.gz", "Monzo")
+    ]
+
+    @pytest.mark.parametrize("statement,bank", test_cases_compressed)
+    def test_compressed_statements_are_read_without_extracting(self, archive_folder, directory, statement, bank):
+        assert detect_bank(archive_folder + statement) == bank
+        plain_statement = "coop_statement.csv" if bank == "Co-operative" else "monzo_statement.csv"
+        outgoings = BANK_FORMATS[bank]["outgoings"]
+        with patch("builtins.input", return_value="Jan Sophie"):
+            assert read_statement(statement, outgoings, "Padme", archive_folder) == read_statement(plain_statement, outgoings, "Padme", directory)
+
+    def test_statements_in_a_zip_file_are_fingerprinted_on_their_own(self, archive_folder):
+        manifest = StatementManifest(archive_folder, "totals.csv")
+        assert manifest.fingerprint("2022/december.zip/coop.csv")["sha256"] == hashlib.sha256(open("test_data/coop_statement.csv", "rb").read()).hexdigest()
+
+
+class TestService:
+
+    @pytest.fixture
+    def service_url(self, tmp_path):
+        (tmp_path / "totals.csv").write_text("owes\n")
+        rules = AssignmentRules([{"description": "train", "type": "", "amount": "", "payers": "Sophie Lou"}])
+        service = CalculatorService(f"{tmp_path}/", "totals.csv", Ledger.from_totals_file(f"{tmp_path}/", "totals.csv"), rules)
+        server = start_server(service)
+        thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+        thread.start()
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+        server.shutdown()
+        server.server_close()
+
+    def request(self, url, data=None):
+        try:
+            with urllib.request.urlopen(url, data) as response:
+                body = response.read().decode()
+                status = response.status
+        except urllib.error.HTTPError as error:
+            body = error.read().decode()
+            status = error.code
+        return status, json.loads(body) if body.startswith(("{", "[")) else body
+
+    def test_uploaded_statement_is_added_once_it_is_answered(self, service_url, tmp_path):
+        status, uploaded = self.request(service_url + "/statements/coop.csv?owner=Jan", open("test_data/coop_statement.csv", "rb").read())
+        assert status == 201
+        assert uploaded["applied"] is False
+        assert [(transaction["row"], transaction["cost"]) for transaction in uploaded["unanswered"]] == [(2, "20.00"), (4, "40.00")]
+        assert self.request(service_url + "/statements")[1][0]["bank"] == "Co-operative"
+
+        status, answered = self.request(service_url + "/statements/coop.csv/answers", json.dumps({"2": "Jan Sophie", "4": "*SKIP*"}).encode())
+        assert (status, answered) == (200, {"statement": "coop.csv", "applied": True, "unanswered": []})
+        assert self.request(service_url + "/statements") == (200, [])
+        assert self.request(service_url + "/totals") == (200, {"header": ["owes", "Jan", "Sophie", "Lou"], "rows": [{"owes": "Jan", "Jan": 0.0, "Sophie": 185.0, "Lou": 175.0}]})
+        assert self.request(service_url + "/settle-up") == (200, [{"payer": "Sophie", "payee": "Jan", "amount": "185.00"}, {"payer": "Lou", "payee": "Jan", "amount": "175.00"}])
+        assert "<td>185.0</td>" in self.request(service_url + "/totals.html")[1]
+        assert (tmp_path / "totals.csv").read_text().splitlines() == ["owes,Jan,Sophie,Lou", "Jan,0.0,185.0,175.0"]
+
+    test_cases_bad_answers = [
+        {"2": "Jan Sophie", "3": "Jan"},
+        {"2": "Jan Sophie", "4": 5},
+        {"2": "Jan Sophie", "4": " "},
+        ["Jan Sophie", "*SKIP*"]
+    ]
+
+    @pytest.mark.parametrize("answers", test_cases_bad_answers)
+    def test_bad_answers_leave_the_statement_waiting(self, service_url, answers):
+        self.request(service_url + "/statements/coop.csv?owner=Jan", open("test_data/coop_statement.csv", "rb").read())
+        status, response = self.request(service_url + "/statements/coop.csv/answers", json.dumps(answers).encode())
+        assert status == 400
+        assert [transaction["row"] for transaction in self.request(service_url + "/statements")[1][0]["unanswered"]] == [2, 4]
+        status, answered = self.request(service_url + "/statements/coop.csv/answers", json.dumps({"2": "Jan Sophie", "4": "*SKIP*"}).encode())
+        assert (status, answered["applied"]) == (200, True)
+
+    def test_statement_that_cant_be_added_is_left_waiting(self, tmp_path):
+        def triage(statement, answers, ask):
+            raise ValueError("Something went wrong")
+        (tmp_path / "totals.csv").write_text("owes\n")
+        service = CalculatorService(f"{tmp_path}/", "totals.csv", Ledger.from_totals_file(f"{tmp_path}/", "totals.csv"), triage=triage)
+        service.upload("coop.csv", "Jan", open("test_data/coop_statement.csv", "rb").read())
+        with pytest.raises(ValueError):
+            service.answer("coop.csv", {"2": "Jan Sophie", "3": "Jan", "4": "*SKIP*"})
+        assert [transaction["row"] for transaction in service.statements()[0]["unanswered"]] == [2, 3, 4]
+
+    test_cases_refused_with_serve = [["--database", "totals.db"], ["--group"]]
+
+    @pytest.mark.parametrize("extra_arguments", test_cases_refused_with_serve)
+    def test_serve_refuses_what_it_cant_keep_up_to_date(self, extra_arguments):
+        with pytest.raises(SystemExit):
+            parse_arguments(["--serve", "0"] + extra_arguments)
+
+    test_cases_errors = [
+        ("/statements/coop.csv", b"Date,Description,Type,Money In, Money Out, Balance\n", 400, "owner"),
+        ("/statements/notes.txt?owner=Jan", b"", 400, ".csv"),
+        ("/statements/cake.csv?owner=Jan", b"When,What,How much\n", 400, "?bank="),
+        ("/statements/missing.csv/answers", b"{}", 404, "missing.csv"),
+        ("/statements/../totals.csv?owner=Jan", b"", 404, "Nothing")
+    ]
+
+    @pytest.mark.parametrize("path,data,expected_status,expected_error", test_cases_errors)
+    def test_bad_requests_are_refused(self, service_url, path, data, expected_status, expected_error):
+        status, response = self.request(service_url + path, data)
+        assert status == expected_status
+        assert expected_error in response["error"]
+
+
+class TestFolderWatcher:
+
+    @pytest.mark.parametrize("use_inotify", [True, False])
+    def test_statements_are_reported_once_they_have_settled(self, tmp_path, use_inotify):
+        (tmp_path / "old.csv").write_text("a")
+        (tmp_path / "totals.csv").write_text("owes\n")
+        watcher = FolderWatcher(f"{tmp_path}/", ignore={"totals.csv"}, interval=0.01, use_inotify=use_inotify)
+        assert watcher.changes() == []
+
+        (tmp_path / "2023").mkdir()
+        (tmp_path / "2023" / "new.csv").write_text("a")
+        (tmp_path / "old.csv").write_text("ab")
+        (tmp_path / "totals.csv").write_text("owes,Jan\n")
+        watcher.wait()
+        assert watcher.changes() == []
+        watcher.wait()
+        assert watcher.changes() == ["2023/new.csv", "old.csv"]
+        assert watcher.changes() == []
+        watcher.close()
+
+    def test_inotify_wakes_as_soon_as_a_statement_is_written(self, tmp_path):
+        watcher = FolderWatcher(f"{tmp_path}/", interval=10)
+        if watcher._inotify is None:
+            pytest.skip("inotify isn't available here")
+        threading.Timer(0.1, (tmp_path / "new.csv").write_text, ["a"]).start()
+        started = time.monotonic()
+        watcher.wait()
+        assert time.monotonic() - started < 5
+        watcher.close()
+
+
+def record_statements_in_session(job):
+    directory, session, statements = job
+    shared = SharedTotals(directory, "totals.csv", session)
+    for number, statement in enumerate(statements):
+        if shared.claim(statement):
+            shared.record(statement, session.capitalize(), "Monzo", {"owes": session.capitalize(), "Jan": 100 + number, "Sophie": 1}, ["Jan", "Sophie"])
+    return len(shared.statements)
+
+
+class TestSharedTotals:
+
+    def test_a_statement_is_only_split_by_the_session_that_claimed_it(self, tmp_path):
+        directory = f"{tmp_path}/"
+        padme = SharedTotals(directory, "totals.csv", "padme")
+        reggie = SharedTotals(directory, "totals.csv", "reggie")
+        assert padme.claim("coop.csv")
+        assert not reggie.claim("coop.csv")
+        assert padme.claim("coop.csv")
+        padme.record("coop.csv", "Padme", "Co-operative", {"owes": "Padme", "Padme": 0, "Jan": 1000}, ["Padme", "Jan"])
+        assert not padme.claim("coop.csv")
+        assert SharedTotals(directory, "totals.csv", "padme").statements["coop.csv"]["owes"] == {"owes": "Padme", "Padme": 0, "Jan": 1000}
+
+    def test_merged_totals_are_the_same_whichever_session_records_first(self, tmp_path):
+        totals = []
+        for order in (["padme", "reggie"], ["reggie", "padme"]):
+            directory = tmp_path / "-".join(order)
+            directory.mkdir()
+            sessions = {session: SharedTotals(f"{directory}/", "totals.csv", session) for session in order}
+            owes = {
+                "padme": ("a.csv", {"owes": "Padme", "Padme": 0, "Jan": 1000}, ["Padme", "Jan"]),
+                "reggie": ("b.csv", {"owes": "Reggie", "Reggie": 0, "Sophie": 250, "Jan": 50}, ["Reggie", "Sophie", "Jan"])
+            }
+            for session in order:
+                statement, owed_from_statement, names = owes[session]
+                sessions[session].claim(statement)
+                sessions[session].record(statement, owed_from_statement["owes"], "Monzo", owed_from_statement, names)
+            totals.append((directory / "totals.csv").read_text())
+        assert totals[0] == totals[1]
+        assert totals[0].splitlines() == ["owes,Padme,Jan,Reggie,Sophie", "Padme,0.0,10.0,0.0,0.0", "Reggie,0.0,0.5,0.0,2.5"]
+
+    def test_sessions_running_at_once_lose_no_updates(self, tmp_path):
+        directory = f"{tmp_path}/"
+        statements = [f"{number:03d}.csv" for number in range(40)]
+        jobs = [(directory, session, statements) for session in ["padme", "reggie", "sophie", "lou"]]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=4) as pool:
+            claimed = list(pool.map(record_statements_in_session, jobs))
+        assert sum(claimed) == len(statements)
+        with open(directory + "totals.csv", "r") as t:
+            rows = list(csv.DictReader(t))
+        assert round(sum(float(row["Jan"]) for row in rows), 2) == sum(100 + number for number in range(40)) / 100
+        assert round(sum(float(row["Sophie"]) for row in rows), 2) == 0.4
+        assert [name for name in os.listdir(directory) if name.endswith(".tmp")] == []
+
+    def test_atomic_write_leaves_the_file_alone_when_writing_fails(self, tmp_path):
+        path = tmp_path / "totals.csv"
+        path.write_text("owes\n")
+        path.chmod(0o640)
+        with pytest.raises(RuntimeError):
+            with atomic_write(str(path)) as totals:
+                totals.write("owes,Jan\n")
+                raise RuntimeError
+        assert path.read_text() == "owes\n"
+        assert os.listdir(tmp_path) == ["totals.csv"]
+        with atomic_write(str(path)) as totals:
+            totals.write("owes,Jan\n")
+        assert path.read_text() == "owes,Jan\n"
+        assert path.stat().st_mode & 0o777 == 0o640
+
+
+class TestPeriodIndex:
+    assignments = {
+        "jan.csv": ("Jan", [
+            (2, {"Date": "2022-11-30"}, 1000, ["Jan", "Sophie"]),
+            (3, {"Date": "2022-12-01"}, 1001, ["Sophie", "Padme", "Jan"]),
+            (4, {"Date": "2023-01-15"}, 700, ["Padme"]),
+            (5, {"Description": "Grouped", "Transactions": 2, "Total": "3.00"}, 300, ["Padme"])
+        ]),
+        "sophie.csv": ("Sophie", [
+            (2, {"Date": "2022-12-31"}, 500, ["Jan"]),
+            (3, {"Date": " 2023-01-02 "}, 250, ["Jan", "Sophie"])
+        ])
+    }
+
+    @pytest.fixture
+    def index(self):
+        index = PeriodIndex()
+        for statement, (owner, assignments) in self.assignments.items():
+            index.add_statement(statement, owner, assignments)
+        return index
+
+    test_cases_between = [
+        ("2022-10-01", "2022-12-31", [{"owes": "Jan", "Sophie": 8.34, "Padme": 3.34, "Jan": 0.0}, {"owes": "Sophie", "Sophie": 0.0, "Padme": 0.0, "Jan": 5.0}]),
+        ("2022-12-01", "2022-12-01", [{"owes": "Jan", "Sophie": 3.34, "Padme": 3.34, "Jan": 0.0}]),
+        ("2023-01-01", "2023-12-31", [{"owes": "Jan", "Sophie": 0.0, "Padme": 7.0, "Jan": 0.0}, {"owes": "Sophie", "Sophie": 0.0, "Padme": 0.0, "Jan": 1.25}]),
+        ("2021-01-01", "2021-12-31", [])
+    ]
+
+    @pytest.mark.parametrize("start,end,expected", test_cases_between)
+    def test_owed_between(self, index, start, end, expected):
+        header, rows = index.owed_between(start, end)
+        assert header == ["owes", "Sophie", "Padme", "Jan"]
+        assert rows == expected
+
+    def test_rolling_days_end_on_the_day_given(self, index):
+        assert index.rolling(30, "2023-01-15") == index.owed_between("2022-12-17", "2023-01-15")
+        assert index.rolling(1, "2022-12-31")[1] == [{"owes": "Sophie", "Sophie": 0.0, "Padme": 0.0, "Jan": 5.0}]
+
+    def test_all_time_matches_the_totals_from_each_statement(self, index):
+        _, rows = index.owed_between("0000-01-01", "9999-12-31")
+        for owner, assignments in self.assignments.values():
+            owed_from_statement, _ = aggregate_owes([assignment for assignment in assignments if "Date" in assignment[1]], owner)
+            row = next(row for row in rows if row["owes"] == owner)
+            assert {person: round(pounds * 100) for person, pounds in row.items() if person != "owes" and pounds} == {person: pence for person, pence in owed_from_statement.items() if person != "owes" and pence}
+
+    test_cases_periods = [
+        ("month", [("2022-11", "2022-11-30", "2022-11-30"), ("2022-12", "2022-12-01", "2022-12-31"), ("2023-01", "2023-01-02", "2023-01-15")]),
+        ("quarter", [("2022-Q4", "2022-11-30", "2022-12-31"), ("2023-Q1", "2023-01-02", "2023-01-15")]),
+        ("year", [("2022", "2022-11-30", "2022-12-31"), ("2023", "2023-01-02", "2023-01-15")])
+    ]
+
+    @pytest.mark.parametrize("period,expected", test_cases_periods)
+    def test_periods(self, index, period, expected):
+        assert index.periods(period) == expected
+
+    def test_saved_index_only_keeps_statements_still_in_the_folder(self, index, tmp_path):
+        path = str(tmp_path / "totals.periods.json")
+        index.save(path)
+        reloaded = PeriodIndex.load(path)
+        assert reloaded.owed_between("2022-01-01", "2023-12-31") == index.owed_between("2022-01-01", "2023-12-31")
+        reloaded.keep(["sophie.csv"])
+        assert reloaded.owed_between("2022-01-01", "2023-12-31") == (["owes", "Jan"], [{"owes": "Sophie", "Jan": 6.25}])
+
+
+class TestSplitPence:
+    test_cases = [
+        (2000, 3, [667, 667, 666]),
+        (4000, 3, [1334, 1333, 1333]),
+        (1500, 2, [750, 750]),
+        (1, 4, [1, 0, 0, 0])
+    ]
+
+    @pytest.mark.parametrize("pence,number_of_people,expected", test_cases)
+    def test_split_pence(self, pence, number_of_people, expected):
+        shares = split_pence(pence, number_of_people)
+        assert shares.tolist() == expected
+        assert shares.sum() == pence
+
+    test_cases_first = [
+        (2000, 3, 1, [666, 667, 667]),
+        (4000, 3, 2, [1333, 1333, 1334]),
+        (1, 4, 3, [0, 0, 0, 1])
+    ]
+
+    @pytest.mark.parametrize("pence,number_of_people,first,expected", test_cases_first)
+    def test_leftover_pennies_start_from_the_first_person_given(self, pence, number_of_people, first, expected):
+        assert split_pence(pence, number_of_people, first).tolist() == expected
+
+    def test_leftover_pennies_are_taken_in_turn(self):
+        assignments = [(row_number, None, 1000, ["Sophie", "Jane", "Sven"]) for row_number in range(3)]
+        assert [shares for _, shares in iter_split_assignments(assignments)] == [[334, 333, 333], [333, 334, 333], [333, 333, 334]]
+
+    def test_aggregated_shares_match_splitting_each_transaction(self):
+        random_generator = numpy.random.default_rng(3)
+        people = ["Jan", "Sophie", "Padme", "Reggie", "Lou"]
+        assignments = []
+        expected = {"owes": "Lou", "Lou": 0}
+        for row_number in range(1, 1001):
+            cost = int(random_generator.integers(1, 100000))
+            people_who_owe = people[:int(random_generator.integers(1, 6))]
+            assignments.append((row_number, None, cost, people_who_owe))
+        for (_, _, _, people_who_owe), shares in iter_split_assignments(assignments):
+            for person, share in zip(people_who_owe, shares):
+                if person != "Lou":
+                    expected[person] = expected.get(person, 0) + share
+
+        owes_from_statement, _ = aggregate_owes(iter(assignments), "Lou")
+        assert owes_from_statement == expected
+
+
+class TestTransactionIndex:
+
+    def test_a_transaction_is_only_a_duplicate_in_another_statement(self, tmp_path):
+        path = str(tmp_path / "totals.transactions.idx")
+        seen = TransactionIndex(path)
+        keys = [short_hash(str(number)) for number in range(5000)]
+        for key in keys:
+            seen.add(key, "december.csv")
+        assert not seen.is_duplicate(keys[0], "december.csv")
+        assert seen.is_duplicate(keys[0], "quarter.csv")
+        seen.save()
+
+        reloaded = TransactionIndex(path)
+        assert all(reloaded.is_duplicate(key, "quarter.csv") for key in keys)
+        assert not any(reloaded.is_duplicate(key, "december.csv") for key in keys)
+        assert not reloaded.is_duplicate(short_hash("new"), "quarter.csv")
+
+    def test_record_cut_short_is_dropped_before_more_are_added(self, tmp_path):
+        path = tmp_path / "totals.transactions.idx"
+        seen = TransactionIndex(str(path))
+        seen.add(short_hash("first"), "december.csv")
+        seen.save()
+        with open(path, "ab") as index_file:
+            index_file.write(b"\x01\x02\x03\x04\x05")
+
+        seen = TransactionIndex(str(path))
+        assert path.stat().st_size == TransactionIndex.record.itemsize
+        seen.add(short_hash("second"), "december.csv")
+        seen.save()
+        reloaded = TransactionIndex(str(path))
+        assert reloaded.is_duplicate(short_hash("first"), "quarter.csv")
+        assert reloaded.is_duplicate(short_hash("second"), "quarter.csv")
+
+    def test_overlapping_statements_are_only_asked_about_once(self, tmp_path):
+        (tmp_path / "december.csv").write_text(
+            "Date,Description,Type,Money In,Amount, Balance\n"
+            "2022-12-23,Reggie Sprouts,BP/SO,,15,85\n"
+            "2022-12-24,Jan         Pizza,BP/SO,,20,65.00\n"
+        )
+        (tmp_path / "quarter.csv").write_text(
+            "Date,Description,Type,Money In,Amount, Balance\n"
+            "2022-11-02,Nice shoes,PURCHASE,,55,10\n"
+            "2022-12-23,Reggie Sprouts,BP/SO,,15,85\n"
+            "2022-12-24,Jan Pizza,BP/SO,,20,65.00\n"
+        )
+        seen = TransactionIndex(str(tmp_path / "totals.transactions.idx"))
+        with patch("builtins.input", side_effect=["Jan", "Jan"]):
+            read_statement("december.csv", "Amount", "Padme", f"{tmp_path}/", seen=seen)
+        with patch("builtins.input", side_effect=["Sophie"]) as mocked_input:
+            owed_from_statement, _ = read_statement("quarter.csv", "Amount", "Padme", f"{tmp_path}/", seen=seen)
+        assert mocked_input.call_count == 1
+        assert owed_from_statement == {"owes": "Padme", "Padme": 0, "Sophie": 5500}
+
+
 class TestReadThenMerge:
     '''Merge the values owed from a statement with the values in a totals spreadsheet'''
     test_cases = [
@@ -269,7 +1080,7 @@ class TestWriteTotalsSpreadsheet:
                 }
             ]
         ),
-        # Can read a spreadsheet, 3 people split cost
+        # Can read a spreadsheet, 3 people split cost, the first person named pays any pennies left over
         # Can merge with prefilled totals spreadsheet
         # Can write to totals statement
         (
@@ -355,6 +1166,109 @@ class TestWriteTotalsSpreadsheet:
             newly_written_totals_sheet = list(reader)
             assert newly_written_totals_sheet == expected 
     
+class TestLedger:
+
+    def test_ledger_only_writes_totals_when_flushed(self, directory, totals_spreadsheet):
+        ledger = Ledger.from_totals_file(directory, totals_spreadsheet)
+        with patch("builtins.input", return_value="Jan"):
+            owed_from_statement, names = read_statement("monzo_statement.csv", "Amount", "Sophie", directory)
+        ledger.apply("Sophie", names, owed_from_statement)
+        with patch("builtins.input", return_value="Sophie Lou"):
+            owed_from_statement, names = read_statement("coop_statement.csv", " Money Out", "Jan", directory)
+        ledger.apply("Jan", names, owed_from_statement)
+
+        with open(directory + totals_spreadsheet, "r") as t:
+            assert list(csv.DictReader(t)) == []
+
+        ledger.flush()
+        with open(directory + totals_spreadsheet, "r") as t:
+            reader = csv.DictReader(t)
+            assert reader.fieldnames == ["owes", "Sophie", "Jan", "Lou"]
+            assert list(reader) == [
+                {"owes": "Sophie", "Sophie": "0.0", "Jan": "90.0", "Lou": "0.0"},
+                {"owes": "Jan", "Sophie": "205.0", "Jan": "0.0", "Lou": "205.0"}
+            ]
+
+    def test_ledger_writes_at_checkpoints(self, directory, totals_spreadsheet):
+        ledger = Ledger.from_totals_file(directory, totals_spreadsheet, checkpoint_every=1)
+        with patch("builtins.input", return_value="Jan"):
+            owed_from_statement, names = read_statement("monzo_statement.csv", "Amount", "Sophie", directory)
+        ledger.apply("Sophie", names, owed_from_statement)
+
+        with open(directory + totals_spreadsheet, "r") as t:
+            assert list(csv.DictReader(t)) == [{"owes": "Sophie", "Sophie": "0.0", "Jan": "90.0"}]
+
+
+    def test_ledger_grows_when_new_people_are_added(self, directory, totals_spreadsheet):
+        ledger = Ledger.from_totals_file(directory, "../prefilled_totals.csv")
+        names = [f"Person{i}" for i in range(50)]
+        ledger.apply("Person0", names, {"owes": "Person0", **{name: 150 for name in names[1:]}})
+        ledger.apply("Sophie", ["Sophie", "Person49"], {"owes": "Sophie", "Person49": 200})
+
+        assert ledger.header == ["owes", "Jan", "Sophie"] + names
+        rows = ledger.rows
+        assert [row["owes"] for row in rows] == ["Sophie", "Jan", "Person0"]
+        assert rows[0]["Jan"] == 100.0
+        assert rows[0]["Person49"] == 2.0
+        assert rows[1]["Person1"] == 0.0
+        assert rows[2]["Person49"] == 1.5
+
+
+class TestSettleUp:
+
+    def test_balances_from_totals(self):
+        ledger = Ledger.from_totals_file("./", "prefilled_totals.csv")
+        assert ledger.balances() == {"Jan": -9000, "Sophie": 9000}
+
+    test_cases = [
+        ({"Jan": -9000, "Sophie": 9000}, [("Jan", "Sophie", 9000)]),
+        ({"Jan": 0, "Sophie": 0}, []),
+        (
+            {"Jan": 5000, "Sophie": -3000, "Padme": -1500, "Reggie": -500},
+            [("Sophie", "Jan", 3000), ("Padme", "Jan", 1500), ("Reggie", "Jan", 500)]
+        ),
+        (
+            {"Jan": 700, "Sophie": 300, "Padme": -600, "Reggie": -400},
+            [("Padme", "Jan", 600), ("Reggie", "Sophie", 300), ("Reggie", "Jan", 100)]
+        )
+    ]
+
+    @pytest.mark.parametrize("balances,expected", test_cases)
+    def test_settle_up(self, balances, expected):
+        assert settle_up(balances) == expected
+
+    def test_everyone_ends_up_even_in_fewer_transfers_than_people(self):
+        random_generator = numpy.random.default_rng(7)
+        owed = random_generator.integers(0, 10000, size=(300, 300))
+        numpy.fill_diagonal(owed, 0)
+        balances = dict(enumerate((owed.sum(axis=1) - owed.sum(axis=0)).tolist()))
+
+        transfers = settle_up(balances)
+        assert len(transfers) < len(balances)
+        for payer, payee, pence in transfers:
+            balances[payer] += pence
+            balances[payee] -= pence
+        assert set(balances.values()) == {0}
+
+
+class TestBenchmarks:
+
+    def test_generated_statements_are_the_same_for_the_same_seed(self, tmp_path):
+        import benchmarks
+        first = benchmarks.generate_statements(str(tmp_path / "first"), 50, 3, 2, 10, 7)
+        second = benchmarks.generate_statements(str(tmp_path / "second"), 50, 3, 2, 10, 7)
+        assert first[1] == second[1] == {"0000_co-operative_statement.csv": "Person0", "0001_monzo_statement.csv": "Person1"}
+        for statement in first[1]:
+            assert open(first[0] + statement).read() == open(second[0] + statement).read()
+            assert detect_bank(first[0] + statement) is not None
+        assert open(first[2]).read() == open(second[2]).read()
+
+    def test_pipeline_benchmark_times_each_stage(self):
+        import benchmarks
+        results = benchmarks.benchmark_pipeline(rows=200, people=4, statements=2, merchants=20, seed=0, runs=1)
+        assert set(results["median_seconds"]) == {"read_statement", "merge_owed_from_statement_with_totals", "write_to_totals_spreadsheet", "create_table_in_html_file", "main"}
+        assert all(seconds >= 0 for seconds in results["median_seconds"].values())
+
 
 def test_create_totals_html_file():
     csv_file = 'prefilled_totals.csv'
@@ -386,4 +1300,19 @@ def test_create_totals_html_file():
     os.remove('test_html2csv.csv')
 
 
+def test_built_in_html_table_matches_pandas(directory, totals_spreadsheet):
+    ledger = Ledger.from_totals_file('./', 'prefilled_totals.csv')
+    html_file = create_table_in_html_file('./', directory + totals_spreadsheet, ledger)
+    with open(html_file, 'r') as h:
+        built_in_html = h.read()
+    os.remove(html_file)
+    assert built_in_html == pandas.read_csv('prefilled_totals.csv').to_html()
+
+
+def test_importing_the_calculator_does_not_import_pandas():
+    script = 'import sys, jointSpendingCalculator; print("pandas" in sys.modules)'
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.stdout.strip() == 'False'
+
+
 